@@ -1,13 +1,20 @@
 import os
-import requests
+import uuid
 import streamlit as st
-import tempfile
 from dotenv import load_dotenv
-from PIL import Image
-import base64
-from io import BytesIO
-from modules.image_processor import generate_high_quality_image
-from modules.product_search import fetch_products
+from modules.image_processor import MAX_SEED, derive_seed, generate_variant, image_to_text_google_vision, vision_cache
+from modules.product_search import fetch_products_concurrently
+from modules.vision_payload import encoder_stats
+from modules.resolution import resolution_stats
+from modules.display import preview_bytes, preview_data_uri
+from modules.image_store import SessionImages, image_store
+from modules.ingest import UploadRejected, ingest
+from modules.prefetch import prefetch
+from modules.jobs import job_manager
+from modules.redesign import run_redesign
+from modules.chat_assistant import chat_with_groq, stream_chat_with_groq, summarize_conversation
+from modules.chat_context import ChatContext, room_context
+from modules import deadline, governor, tracing
 
 # ─── Initialize session_state keys ──────────────────────────────────────────
 if "chat_open" not in st.session_state:
@@ -16,6 +23,24 @@ if "chat_history" not in st.session_state:
     st.session_state.chat_history = []
 if "chat_input" not in st.session_state:
     st.session_state.chat_input = ""
+if "pending_reply" not in st.session_state:
+    st.session_state.pending_reply = False
+if "chat_metrics" not in st.session_state:
+    st.session_state.chat_metrics = {}
+if "chat_shown" not in st.session_state:
+    st.session_state.chat_shown = 0  # bubbles revealed with "Load earlier" on top of the latest page
+if "chat_context" not in st.session_state:
+    st.session_state.chat_context = ChatContext(summarize_conversation)
+if "use_room_context" not in st.session_state:
+    st.session_state.use_room_context = True
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
+if "images" not in st.session_state:
+    # Images live in the shared store by handle; released when this session's state is dropped
+    st.session_state.images = SessionImages(image_store)
+
+# Upstream calls from this run (and the jobs it starts) queue fairly against other sessions
+governor.set_session(st.session_state.session_id)
 
 # ─── Load .env ───────────────────────────────────────────────────────────────
 load_dotenv()
@@ -28,6 +53,11 @@ if API_KEY is None:
     st.error("🔑 GOOGLE_VISION_API_KEY not found in .env. Please add it before running.")
     st.stop()
 
+# Prometheus-style /metrics for the stage timings; off unless a port is given.
+METRICS_PORT = os.getenv("METRICS_PORT")
+if METRICS_PORT:
+    tracing.start_metrics_server(int(METRICS_PORT))
+
 
 # ─── Background and header styling ───────────────────────────────────────────
 st.markdown("""
@@ -50,158 +80,312 @@ with col1:
     uploaded_image = st.file_uploader("📷 Upload Room Image", type=["png", "jpg", "jpeg"])
 with col2:
     style_prompt = st.text_input("🎨 Describe Your Desired Style", placeholder="e.g. Natural tones, Scandinavian simplicity...")
+    fixed_seed = st.checkbox("🔒 Reproducible result", value=True, help="Same photo and style always give the same design (and reuse earlier renders).")
 
-# ─── Trending Styles ─────────────────────────────────────────────────────────
-st.markdown("### ✨ Need Inspiration? Try a Trending Style:")
-for style in ["Scandinavian Minimalism", "Boho Chic", "Modern Farmhouse", "Japandi", "Industrial Loft", "Mid-century Modern", "Contemporary Luxe"]:
-    st.markdown(f"- {style}")
 
-# ─── Image Processing ─────────────────────────────────────────────────────────
-def to_base64(img):
-    buff = BytesIO()
-    img.save(buff, format="PNG")
-    return base64.b64encode(buff.getvalue()).decode()
-
-def save_image(image):
-    path = "RedesignedRoom.png"
-    image.save(path)
-    return path
-
-def detect_labels(img: Image.Image):
-    with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as temp:
-        img.save(temp.name)
-        with open(temp.name, "rb") as image_file:
-            encoded_image = base64.b64encode(image_file.read()).decode("utf-8")
-
-    url = f"https://vision.googleapis.com/v1/images:annotate?key={API_KEY}"
-    payload = {
-        "requests": [{
-            "image": {"content": encoded_image},
-            "features": [{"type": "LABEL_DETECTION", "maxResults": 10}]
-        }]
-    }
+def cancel_variants():
+    for variant in st.session_state.get("variants", []):
+        if variant["job_id"]:
+            job_manager.cancel(variant["job_id"])
 
-    response = requests.post(url, json=payload)
-    result = response.json()
 
-    if "responses" not in result:
-        st.error(f"Google Vision API error: Missing 'responses' key.\nFull response: {result}")
-        return []
+def load_upload(uploaded):
+    """
+    Stores a new upload in the image store (results of an earlier photo are
+    dropped and its redesign and variants cancelled) and starts prefetching
+    its analysis; returns it decoded, or None if the file was rejected.
+    """
+    images = st.session_state.images
+    if st.session_state.get("orig_file_id") != uploaded.file_id:
+        if st.session_state.get("job_id"):
+            job_manager.cancel(st.session_state.job_id)
+        cancel_variants()
+        for key in ("job_id", "finished_job", "show_result", "last_prompt", "deadline_at", "product_results"):
+            st.session_state.pop(key, None)
+        images.discard(st.session_state.pop("orig_handle", None), st.session_state.pop("stylized_handle", None))
+        st.session_state.orig_file_id = uploaded.file_id
+        st.session_state.upload_error = None
+        try:
+            image = ingest(uploaded.getvalue())
+        except UploadRejected as e:
+            st.session_state.upload_error = f"🚫 {e}"
+        else:
+            st.session_state.orig_handle = images.put(image)
+            prefetch(image)
+    if "orig_handle" not in st.session_state:
+        st.error(st.session_state.upload_error)
+        return None
+    return images.get(st.session_state.orig_handle)
 
-    if not result["responses"]:
-        st.error(f"Google Vision API error: Empty 'responses' list.\nFull response: {result}")
-        return []
 
-    response0 = result["responses"][0]
-    if "error" in response0:
-        err = response0["error"]
-        st.error(f"Google Vision API error: {err.get('message', str(err))}")
-        return []
+# Ingest and start the analysis as soon as a photo arrives, while the user is still typing a style
+orig_img = load_upload(uploaded_image) if uploaded_image else None
 
-    labels = [annotation["description"] for annotation in response0.get("labelAnnotations", [])]
-    return labels
+# ─── Trending Styles ─────────────────────────────────────────────────────────
+TRENDING_STYLES = ["Scandinavian Minimalism", "Boho Chic", "Modern Farmhouse", "Japandi", "Industrial Loft", "Mid-century Modern", "Contemporary Luxe"]
 
+st.markdown("### ✨ Need Inspiration? Try a Trending Style:")
+for style in TRENDING_STYLES:
+    st.markdown(f"- {style}")
+
+STAGE_PROGRESS = {
+    None: (0.02, "Queued…"),
+    "analyzing": (0.1, "🔍 Analyzing your room…"),
+    "prompting": (0.25, "✍️ Building the design prompt…"),
+    "generating": (0.4, "🎨 Generating the redesign…"),
+    "detecting products": (0.9, "🛋 Detecting newly added items…"),
+}
 
 if st.button("✨ Generate Redesign"):
-    if uploaded_image and style_prompt:
-        if "orig_img" not in st.session_state:
-            st.session_state.orig_img = Image.open(uploaded_image).convert("RGB")
-        if "stylized_img" not in st.session_state or st.session_state.get("last_prompt") != style_prompt:
-            st.session_state.stylized_img = generate_high_quality_image(st.session_state.orig_img, style_prompt)
+    if orig_img is not None and style_prompt:
+        running = st.session_state.get("job_id")
+        if running and st.session_state.get("last_prompt") == style_prompt:
+            pass  # already rendering this style; don't start a second job
+        elif "stylized_handle" not in st.session_state or st.session_state.get("last_prompt") != style_prompt:
+            if running:
+                # A new style replaces the one in flight instead of competing with it for a worker
+                job_manager.cancel(running)
+            seed = derive_seed(orig_img, style_prompt) if fixed_seed else None
+            # One budget for the whole click, queueing and the product lookups on the result page included
+            st.session_state.deadline_at = deadline.expires_in(deadline.REDESIGN_DEADLINE)
+            with deadline.scope(st.session_state.deadline_at):
+                st.session_state.job_id = job_manager.submit(run_redesign, orig_img, style_prompt, seed=seed)
             st.session_state.last_prompt = style_prompt
+        st.session_state.show_result = True
+    else:
+        st.warning("Please upload an image and enter a style description.")
 
-        orig_img = st.session_state.orig_img
-        stylized_img = st.session_state.stylized_img
-
-        before_b64 = to_base64(orig_img)
-        after_b64 = to_base64(stylized_img)
-
-        st.markdown("### 🔄 Before & After Slider")
-        st.components.v1.html(f"""
-            <div style='position:relative;max-width:900px;margin:auto;'>
-                <input type='range' min='0' max='100' value='50' style='width:100%;height:8px;appearance:none;background:linear-gradient(to right,#DA4D7F 0%,#5A47C2 100%);border-radius:5px;margin-bottom:15px;' oninput='document.getElementById("sliderImg2").style.clipPath = "inset(0 " + (100-this.value) + "% 0 0)"' />
-                <div style='position:relative;overflow:hidden;'>
-                    <img src='data:image/png;base64,{before_b64}' style='width:100%;display:block;' />
-                    <img id='sliderImg2' src='data:image/png;base64,{after_b64}' style='width:100%;position:absolute;top:0;left:0;clip-path:inset(0 50% 0 0);transition:clip-path 0.1s;' />
-                </div>
+# ─── Generation Job Progress ─────────────────────────────────────────────────
+@st.fragment(run_every=1)
+def job_progress():
+    """Polls the background redesign job; only this fragment reruns while it is in flight."""
+    job = job_manager.poll(st.session_state.job_id)
+    if job and job["status"] in ("queued", "running"):
+        fraction, text = STAGE_PROGRESS.get(job["stage"], (0.5, job["stage"]))
+        if job["status"] == "queued" and job["position"] > 1:
+            text = f"Waiting for a free worker (position {job['position']} in queue)…"
+        for upstream, position in governor.queue_status(st.session_state.session_id).items():
+            text = f"Waiting for {governor.UPSTREAM_NAMES[upstream]} (position {position} in queue)…"
+        st.progress(fraction, text=f"{text} ({job['elapsed']:.0f}s)")
+        if st.button("✖ Cancel Redesign"):
+            job_manager.cancel(job["id"])
+            st.rerun()
+        return
+
+    # Finished, failed or cancelled: hand over to a full rerun to show the outcome
+    st.session_state.finished_job = job
+    st.session_state.job_id = None
+    st.rerun()
+
+
+finished = st.session_state.pop("finished_job", None)
+products_deadline = None
+if finished:
+    # Only the rerun that picks up the job spends what is left of its deadline
+    products_deadline = st.session_state.pop("deadline_at", None)
+    if finished["status"] == "done":
+        images = st.session_state.images
+        images.discard(st.session_state.get("stylized_handle"))
+        st.session_state.stylized_handle = images.put(finished["result"]["image"])
+        st.session_state.new_items = finished["result"]["new_items"]
+        st.session_state.pop("product_results", None)
+        for warning in finished["result"]["warnings"]:
+            st.error(warning)
+    elif finished["status"] == "failed":
+        st.session_state.show_result = False
+        st.session_state.pop("last_prompt", None)
+        if isinstance(finished["error"], (governor.Busy, governor.QuotaExceeded)):
+            st.warning(f"⏳ {finished['error']}")
+        elif isinstance(finished["error"], deadline.DeadlineExceeded):
+            st.warning(f"⏳ The redesign took longer than {deadline.REDESIGN_DEADLINE:.0f}s and was stopped; please try again.")
+        else:
+            st.error(f"Redesign failed: {finished['error']}")
+    else:
+        st.session_state.show_result = False
+        st.session_state.pop("last_prompt", None)
+        st.info("Redesign cancelled.")
+
+if st.session_state.get("job_id"):
+    job_progress()
+
+def show_products(item, products, error):
+    """One keyword's recommendations; searches skipped for time are summed up by the caller."""
+    if isinstance(error, TimeoutError):
+        return
+    if error is not None:
+        st.warning(f"Couldn't fetch products for *{item}*: {error}")
+        return
+    for p in products:
+        st.markdown(f"- *{item}* → [{p['name']}]({p['url']})")
+
+
+if st.session_state.get("show_result") and not st.session_state.get("job_id") and "stylized_handle" in st.session_state:
+    before_img = st.session_state.images.get(st.session_state.orig_handle)
+    stylized_img = st.session_state.images.get(st.session_state.stylized_handle)
+    try:
+        # Served from the Vision cache filled during generation
+        st.session_state.room_note = room_context(image_to_text_google_vision(before_img))
+    except Exception:
+        st.session_state.room_note = ""
+
+    before_src = preview_data_uri(before_img)
+    after_src = preview_data_uri(stylized_img)
+
+    st.markdown("### 🔄 Before & After Slider")
+    st.components.v1.html(f"""
+        <div style='position:relative;max-width:900px;margin:auto;'>
+            <input type='range' min='0' max='100' value='50' style='width:100%;height:8px;appearance:none;background:linear-gradient(to right,#DA4D7F 0%,#5A47C2 100%);border-radius:5px;margin-bottom:15px;' oninput='document.getElementById("sliderImg2").style.clipPath = "inset(0 " + (100-this.value) + "% 0 0)"' />
+            <div style='position:relative;overflow:hidden;'>
+                <img src='{before_src}' style='width:100%;display:block;' />
+                <img id='sliderImg2' src='{after_src}' style='width:100%;position:absolute;top:0;left:0;clip-path:inset(0 50% 0 0);transition:clip-path 0.1s;' />
             </div>
-        """, height=500)
-
-        st.markdown("### 🛋 Recommended Products")
-        before_labels = set(detect_labels(orig_img))
-        after_labels = set(detect_labels(stylized_img))
-        room_keywords = {
-            "wall", "floor", "ceiling", "room", "house", "lighting", "wood", "window",
-            "interior design", "home", "architecture", "tile", "fixture",
-            "living room", "dining room", "bedroom", "kitchen", "bathroom",
-            "hallway", "office", "study", "closet", "garage", "laundry room"
-        }
-
-        new_items = [
-            label for label in after_labels - before_labels
-            if not any(room in label.lower() for room in room_keywords)
-        ]
-        if new_items:
-            st.success("Newly added items: " + ", ".join(new_items))
-            for item in new_items:
-                products = fetch_products(item)
-                for p in products:
-                    st.markdown(f"- *{item}* → [{p['name']}]({p['url']})")
+        </div>
+    """, height=500)
+
+    st.markdown("### 🛋 Recommended Products")
+    new_items = st.session_state.get("new_items", [])
+    if new_items:
+        st.success("Newly added items: " + ", ".join(new_items))
+        results = st.session_state.get("product_results")
+        if results is None:
+            results = []
+            # Searches that don't fit the redesign's remaining deadline are served from the store or skipped
+            with deadline.scope(products_deadline):
+                for result in fetch_products_concurrently(new_items):
+                    results.append(result)
+                    show_products(*result)
+            # Later reruns show the same list instead of searching again
+            st.session_state.product_results = results
         else:
-            st.info("No new relevant items detected.")
-
-        # Save once and read to memory to prevent rerun side effects
-        output_path = save_image(stylized_img)
-        with open(output_path, "rb") as f:
-            image_bytes = f.read()
-
-        st.download_button(
-            label="⬇ Download Redesigned Image",
-            data=image_bytes,
-            file_name="RedesignedRoom.png",
-            mime="image/png"
-        )
+            for result in results:
+                show_products(*result)
+        skipped = [item for item, _, error in results if isinstance(error, TimeoutError)]
+        if skipped:
+            st.info("Skipped product suggestions for " + ", ".join(f"*{item}*" for item in skipped) + " to keep the page fast.")
+        failed = [item for item, _, error in results if error is not None]
+        if failed and st.button("🔎 Search again"):
+            # Keep what was found; only the skipped or failed keywords are searched again
+            retried = {result[0]: result for result in fetch_products_concurrently(failed)}
+            st.session_state.product_results = [retried.get(result[0], result) for result in results]
+            st.rerun()
     else:
-        st.warning("Please upload an image and enter a style description.")
+        st.info("No new relevant items detected.")
+
+    cache_stats = vision_cache.stats()
+    payload_stats = encoder_stats()
+    size_stats = resolution_stats()
+    st.caption(
+        f"Vision cache: {cache_stats['hits']} hits / {cache_stats['misses']} misses, "
+        f"~{cache_stats['saved_seconds']:.1f}s of API latency saved, "
+        f"~{payload_stats['bytes_saved'] / 1e6:.1f} MB of upload saved by downscaling, "
+        f"~{size_stats['estimated_seconds_saved']:.0f}s of generation saved by rendering at SDXL's native size"
+    )
+
+    st.download_button(
+        label="⬇ Download Redesigned Image",
+        data=st.session_state.images.get_bytes(st.session_state.stylized_handle),  # already a PNG
+        file_name="RedesignedRoom.png",
+        mime="image/png"
+    )
+
+    if st.button("🔁 Regenerate", help="Render a fresh variation with a new seed, bypassing saved results"):
+        st.session_state.deadline_at = deadline.expires_in(deadline.REDESIGN_DEADLINE)
+        with deadline.scope(st.session_state.deadline_at):
+            st.session_state.job_id = job_manager.submit(
+                run_redesign, before_img, st.session_state.last_prompt, seed=None, use_cache=False
+            )
+        st.rerun()
+
+# ─── Compare Styles ──────────────────────────────────────────────────────────
+def collect_variant(variant):
+    """Moves a finished variant job's image (or error) onto its grid entry; returns False while it runs."""
+    job = job_manager.poll(variant["job_id"])
+    if job and job["status"] in ("queued", "running"):
+        variant["stage"] = job["stage"]
+        return False
+    variant["job_id"] = None
+    if job is None or job["status"] == "cancelled":
+        variant["error"] = "cancelled"
+    elif job["status"] == "done":
+        variant["seed"] = job["result"]["seed"]
+        variant["handle"] = st.session_state.images.put(job["result"]["image"])
+    elif isinstance(job["error"], deadline.DeadlineExceeded):
+        variant["error"] = f"skipped to stay within {deadline.VARIANTS_DEADLINE:.0f}s"
+    else:
+        variant["error"] = str(job["error"])
+    return True
+
+
+def show_variant_grid():
+    grid = st.columns(3)
+    for i, variant in enumerate(st.session_state.variants):
+        style, seed, handle = variant["style"], variant["seed"], variant["handle"]
+        if handle:
+            grid[i % 3].image(preview_bytes(st.session_state.images.get(handle), 640), caption=f"{style} · seed {seed}", width="stretch")
+        elif variant["error"]:
+            grid[i % 3].error(f"{style}: {variant['error']}")
+        else:
+            grid[i % 3].info(f"⏳ {style}: {STAGE_PROGRESS.get(variant['stage'], (0, variant['stage']))[1]}")
+
+
+@st.fragment(run_every=1)
+def variant_progress():
+    """Polls the variant jobs; only this fragment reruns while any of them is in flight."""
+    running = [variant for variant in st.session_state.variants if variant["job_id"] and not collect_variant(variant)]
+    if not running:
+        # All finished: hand over to a full rerun, which shows the grid without polling
+        st.rerun()
+    show_variant_grid()
+    if st.button("✖ Cancel Variants"):
+        cancel_variants()
+        st.rerun()
+
+
+with st.expander("🎭 Compare several looks side by side"):
+    compare_styles = st.multiselect("Styles to compare", TRENDING_STYLES, default=TRENDING_STYLES[:3])
+    seeds_per_style = st.number_input("Variations per style", min_value=1, max_value=3, value=1)
+    if st.button("🖼 Generate Variants"):
+        if orig_img is not None and compare_styles:
+            base = orig_img
+            variants = [
+                (style, (derive_seed(base, style) + n) % (MAX_SEED + 1) if fixed_seed else None)
+                for style in compare_styles for n in range(int(seeds_per_style))
+            ]
+            cancel_variants()
+            st.session_state.images.discard(*(v["handle"] for v in st.session_state.get("variants", [])))
+            # One job per look on the shared worker pool, all within one budget for the click
+            with deadline.scope(deadline.expires_in(deadline.VARIANTS_DEADLINE)):
+                st.session_state.variants = [
+                    {"style": style, "seed": seed, "stage": None, "handle": None, "error": None,
+                     "job_id": job_manager.submit(generate_variant, base, style, seed=seed)}
+                    for style, seed in variants
+                ]
+        else:
+            st.warning("Please upload an image and pick at least one style.")
+    if any(variant["job_id"] for variant in st.session_state.get("variants", [])):
+        variant_progress()
+    elif st.session_state.get("variants"):
+        show_variant_grid()
 
 # ─── Chat Assistant Toggle ────────────────────────────────────────────────────
 st.markdown("")
 if st.button("💬 Chat with Assistant"):
     st.session_state.chat_open = True
 
-def chat_with_groq(user_message, history):
-    """
-    Sends the full conversation (history + new user message) to Groq’s
-    chat completions endpoint using the Llama 4 Scout model, returning the reply.
-    """
-    url = "https://api.groq.com/openai/v1/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {GROQ_API_KEY}",
-        "Content-Type": "application/json",
-    }
-    # Build messages payload:
-    messages = [
-        {"role": "system", "content": "You are a helpful interior-design assistant."}
-    ]
-    for entry in history:
-        messages.append({"role": entry["role"], "content": entry["content"]})
-    messages.append({"role": "user", "content": user_message})
-
-    payload = {
-        "model": "meta-llama/llama-4-scout-17b-16e-instruct",
-        "messages": messages,
-        "temperature": 0.7,
-        "max_tokens": 512,
-    }
-
-    resp = requests.post(url, json=payload, headers=headers, timeout=30)
-    resp.raise_for_status()
-    data = resp.json()
-    return data["choices"][0]["message"]["content"].strip()
+CHAT_STREAMING = os.getenv("CHAT_STREAMING", "1") == "1"
+# Bubbles rendered at once; older ones are revealed a page at a time.
+CHAT_PAGE_SIZE = int(os.getenv("CHAT_PAGE_SIZE", "30"))
 
+def build_chat_context():
+    """System notes and the history tail for the latest user message, within the token budget."""
+    history = st.session_state.chat_history
+    room_note = st.session_state.get("room_note", "") if st.session_state.use_room_context else ""
+    return st.session_state.chat_context.build(history[:-1], history[-1]["content"], room_note)
 
 # ─── Callback: When user presses Enter in chat_input ─────────────────────────
 def submit_message():
+    # Callbacks of a fragment-only rerun run on a fresh thread, before the fragment itself
+    governor.set_session(st.session_state.session_id)
     user_msg = st.session_state.chat_input.strip()
     if not user_msg:
         return  # ignore empty
@@ -209,11 +393,16 @@ def submit_message():
     # Append user message
     st.session_state.chat_history.append({"role": "user", "content": user_msg})
 
+    # Streamed replies are rendered token by token in the sidebar below
+    if CHAT_STREAMING:
+        st.session_state.pending_reply = True
+        st.session_state.chat_input = ""
+        return
+
     # Call Groq for assistant reply
     try:
-        assistant_reply = chat_with_groq(
-            user_msg, st.session_state.chat_history[:-1]
-        )
+        notes, recent = build_chat_context()
+        assistant_reply = chat_with_groq(user_msg, recent, notes)
     except Exception as e:
         assistant_reply = f"⚠ Error contacting Groq: {e}"
 
@@ -224,6 +413,144 @@ def submit_message():
     st.session_state.chat_input = ""
 
 
+def stream_pending_reply(placeholder):
+    """
+    Streams the assistant reply for the last user message into a live
+    bubble in `placeholder`. If the run is interrupted (Stop, closing the
+    chat, any other widget outside the chat fragment) the partial reply is
+    kept and the connection closed. Must run in a full-page run: a click
+    inside a fragment waits for the running script instead of stopping it.
+    """
+    metrics = {}
+    parts = []
+    stopped = True
+    try:
+        notes, recent = build_chat_context()
+    except Exception:
+        notes, recent = [], st.session_state.chat_history[:-1]
+    replies = stream_chat_with_groq(st.session_state.chat_history[-1]["content"], recent, metrics, notes)
+    try:
+        for delta in replies:
+            parts.append(delta)
+            placeholder.markdown(
+                f"<div class='chat-bubble chat-assistant'>{''.join(parts)}▌</div>",
+                unsafe_allow_html=True
+            )
+        stopped = False
+    except Exception as e:
+        if not parts:
+            parts.append(f"⚠ Error contacting Groq: {e}")
+        stopped = False
+    finally:
+        replies.close()
+        reply = "".join(parts).strip()
+        if stopped:
+            reply = (reply + " …(stopped)").strip()
+        st.session_state.chat_history.append({"role": "assistant", "content": reply})
+        st.session_state.pending_reply = False
+        st.session_state.chat_metrics = metrics
+    placeholder.markdown(
+        f"<div class='chat-bubble chat-assistant'>{reply}</div>",
+        unsafe_allow_html=True
+    )
+
+
+def close_chat():
+    st.session_state.chat_open = False
+    st.session_state.chat_input = ""
+    st.session_state.pending_reply = False
+
+
+def load_earlier():
+    st.session_state.chat_shown += CHAT_PAGE_SIZE
+
+
+def bubble(msg) -> str:
+    role_class = "chat-user" if msg["role"] == "user" else "chat-assistant"
+    return f"<div class='chat-bubble {role_class}'>{msg['content']}</div>"
+
+
+# ─── Chat Panel Fragment ─────────────────────────────────────────────────────
+@st.fragment
+def chat_panel():
+    """
+    The sidebar chat. Sending a message and "Load earlier" rerun only this
+    fragment, not the page; only the latest CHAT_PAGE_SIZE bubbles (plus
+    pages revealed on request) are rendered, as a single element. While a
+    reply is pending returns (stop_slot, reply_slot, metrics_slot, render)
+    for the page run to stream it into, else None.
+    """
+    # A fragment-only rerun runs on a new thread without the page's governor session
+    governor.set_session(st.session_state.session_id)
+    page_run = st.session_state.pop("chat_page_run", False)
+    streaming = st.session_state.pending_reply and st.session_state.chat_open
+    if streaming and not page_run:
+        # Stream in a full-page run so that Stop and close can interrupt it
+        st.rerun()
+
+    history = st.session_state.chat_history
+    # Ended before streaming, so it measures the panel's rerun cost, not the wait on Groq
+    render = tracing.Span("chat.render", tracing.current_span(), messages=len(history))
+
+    # Scrollable messages
+    hidden = max(0, len(history) - CHAT_PAGE_SIZE - st.session_state.chat_shown)
+    if hidden:
+        st.button(f"⬆ Load earlier messages ({hidden} more)", key="load_earlier_btn", on_click=load_earlier)
+    render.set(rendered=len(history) - hidden)
+    st.markdown(
+        "<div class='chat-scroll' id='chat-scroll-box'>" + "".join(bubble(msg) for msg in history[hidden:]) + "</div>",
+        unsafe_allow_html=True
+    )
+    if streaming:
+        stop_slot = st.empty()
+        reply_slot = st.empty()
+
+    metrics_slot = st.empty()
+
+    if st.session_state.get("room_note"):
+        st.checkbox("Use my room's analysis", key="use_room_context")
+
+    # Input
+    st.markdown("<div class='chat-input-box'>", unsafe_allow_html=True)
+    st.text_input(
+        label="",
+        placeholder="Type a message and press Enter…",
+        key="chat_input",
+        on_change=submit_message
+    )
+    st.markdown("</div>", unsafe_allow_html=True)
+
+    # Auto-scroll JS
+    st.markdown("""
+    <script>
+    const chatScroll = document.getElementById('chat-scroll-box');
+    if (chatScroll) {
+        chatScroll.scrollTop = chatScroll.scrollHeight;
+    }
+    </script>
+    """, unsafe_allow_html=True)
+
+    tracing.finish(render)
+    if streaming:
+        return stop_slot, reply_slot, metrics_slot, render
+    show_chat_metrics(metrics_slot, render)
+    return None
+
+
+def show_chat_metrics(slot, render):
+    metrics = st.session_state.chat_metrics
+    caption = f"Rendered in {render.duration * 1000:.0f} ms"
+    if "total" in metrics:
+        ttft = f"{metrics['ttft']:.2f}s" if "ttft" in metrics else "–"
+        caption = f"First token {ttft} · total {metrics['total']:.2f}s · {caption}"
+    slot.caption(caption)
+
+
+# Detect manual JS trigger
+if st.query_params.get("close_chat"):
+    st.session_state.chat_open = False
+    st.session_state.chat_input = ""
+
 # ─── CSS: Hide or Float Sidebar Based on chat_open ─────────────────────────
 if st.session_state.chat_open:
     # When chat_open=True → show & float the sidebar as a bottom-right popup
@@ -364,9 +691,9 @@ if st.session_state.chat_open:
     """, unsafe_allow_html=True)
 
     with st.sidebar:
-
-        # Chat header with real Streamlit close button
-        # Container for header with aligned title and close button
+        # Chat header with real Streamlit close button; outside the fragment so
+        # a click reruns the page (hiding the sidebar needs its CSS to change)
+        # and interrupts a reply being streamed
         header_cols = st.columns([9, 1])  # Wide for title, small for button
 
         with header_cols[0]:
@@ -374,44 +701,14 @@ if st.session_state.chat_open:
                         unsafe_allow_html=True)
 
         with header_cols[1]:
-            if st.button("✖", key="close_chat_btn", help="Close chat"):
-                st.session_state.chat_open = False
-                st.session_state.chat_input = ""
-                # st.experimental_rerun()
-
-        # Detect manual JS trigger
-        if st.query_params.get("close_chat"):
-            st.session_state.chat_open = False
-            st.session_state.chat_input = ""
-
-        # Scrollable messages
-        st.markdown("<div class='chat-scroll' id='chat-scroll-box'>", unsafe_allow_html=True)
-        for msg in st.session_state.chat_history:
-            role_class = "chat-user" if msg["role"] == "user" else "chat-assistant"
-            st.markdown(
-                f"<div class='chat-bubble {role_class}'>{msg['content']}</div>",
-                unsafe_allow_html=True
-            )
-        st.markdown("</div>", unsafe_allow_html=True)
-
-        # Input
-        st.markdown("<div class='chat-input-box'>", unsafe_allow_html=True)
-        st.text_input(
-            label="",
-            placeholder="Type a message and press Enter…",
-            key="chat_input",
-            on_change=submit_message
-        )
-        st.markdown("</div>", unsafe_allow_html=True)
-
-        st.markdown("</div>", unsafe_allow_html=True)
-
-        # Auto-scroll JS
-        st.markdown("""
-        <script>
-        const chatScroll = document.getElementById('chat-scroll-box');
-        if (chatScroll) {
-            chatScroll.scrollTop = chatScroll.scrollHeight;
-        }
-        </script>
-        """, unsafe_allow_html=True)
\ No newline at end of file
+            st.button("✖", key="close_chat_btn", help="Close chat", on_click=close_chat)
+
+        st.session_state.chat_page_run = True
+        pending = chat_panel()
+        if pending:
+            stop_slot, reply_slot, metrics_slot, render = pending
+            # Created outside the fragment, so a click reruns the page and stops the stream
+            stop_slot.button("⏹ Stop", key="stop_reply_btn", help="Stop generating")
+            stream_pending_reply(reply_slot)
+            stop_slot.empty()
+            show_chat_metrics(metrics_slot, render)
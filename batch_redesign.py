@@ -0,0 +1,217 @@
+"""
+Headless batch redesign: runs every image × style through the same
+pipeline as the app (SDXL render, label diff, product search) without
+Streamlit, writing each render and a line of manifest.jsonl to the output
+directory as soon as the item finishes.
+
+    python batch_redesign.py photos/ --style "Japandi" --style "Boho Chic" --out redesigns/
+    python batch_redesign.py items.jsonl --out redesigns/ --concurrency 4
+
+Inputs are a directory of images (searched recursively) or a manifest
+file with one item per line: an image path, or a JSON object
+{"image": path, "style": optional style}. Rerunning with the same output
+directory skips items that already finished, so a crashed run resumes
+where it stopped; failed items are retried.
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from modules.cache import make_key
+from modules.image_processor import derive_seed, normalize_style
+from modules.ingest import ingest
+from modules.product_search import fetch_products_concurrently
+from modules.redesign import run_redesign
+
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".webp"}
+MANIFEST_NAME = "manifest.jsonl"
+
+logger = logging.getLogger("batch_redesign")
+
+
+def slugify(text: str, limit=40) -> str:
+    return re.sub(r"[^a-z0-9]+", "-", text.lower()).strip("-")[:limit] or "style"
+
+
+def discover(source: str, styles: list) -> list:
+    """Expands a directory or manifest into (image path, style) pairs."""
+    pairs = []
+    if os.path.isdir(source):
+        for root, _, files in os.walk(source):
+            for name in sorted(files):
+                if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                    pairs.extend((os.path.join(root, name), style) for style in styles)
+        return sorted(pairs)
+
+    base = os.path.dirname(os.path.abspath(source))
+    with open(source, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("{"):
+                entry = json.loads(line)
+                path, entry_styles = entry["image"], [entry["style"]] if entry.get("style") else styles
+            else:
+                path, entry_styles = line, styles
+            path = path if os.path.isabs(path) else os.path.join(base, path)
+            pairs.extend((path, style) for style in entry_styles)
+    return pairs
+
+
+def item_id(path: str, style: str, seed) -> str:
+    return make_key(os.path.abspath(path), normalize_style(style), seed)[:16]
+
+
+def load_finished(manifest_path: str) -> set:
+    """Ids of items recorded as done; a line cut short by a crash is ignored."""
+    finished = set()
+    if not os.path.exists(manifest_path):
+        return finished
+    with open(manifest_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("status") == "ok":
+                finished.add(record["id"])
+    return finished
+
+
+class ManifestWriter:
+    """Appends one JSON line per finished item and flushes it to disk immediately."""
+
+    def __init__(self, path):
+        self._file = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def write(self, record: dict):
+        with self._lock:
+            self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+def process(path, style, seed, key, out_dir, with_products) -> dict:
+    with open(path, "rb") as f:
+        image = ingest(f.read())
+    seed = derive_seed(image, style) if seed is None else seed
+    result = run_redesign(image, style, seed=seed)
+
+    output = os.path.join(out_dir, f"{os.path.splitext(os.path.basename(path))[0]}--{slugify(style)}-{key[:8]}.png")
+    tmp_path = output + ".tmp"
+    result["image"].save(tmp_path, format="PNG")
+    os.replace(tmp_path, output)
+
+    products, warnings = {}, list(result["warnings"])
+    if with_products:
+        for keyword, found, error in fetch_products_concurrently(result["new_items"]):
+            if error is not None:
+                warnings.append(f"Product search for '{keyword}' failed: {error}")
+            products[keyword] = found
+    return {
+        "seed": seed,
+        "output": output,
+        "new_items": result["new_items"],
+        "products": products,
+        "warnings": warnings,
+    }
+
+
+def run_batch(pairs, out_dir, concurrency=2, seed=None, with_products=True) -> dict:
+    """
+    Processes (image path, style) pairs with at most `concurrency` items in
+    flight, skipping the ones already recorded as done in the manifest.
+    Returns counts of ok, failed and skipped items.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    manifest_path = os.path.join(out_dir, MANIFEST_NAME)
+    finished = load_finished(manifest_path)
+    writer = ManifestWriter(manifest_path)
+    counts = {"ok": 0, "failed": 0, "skipped": 0}
+    total = len(pairs)
+
+    def task(path, style, key):
+        started = time.perf_counter()
+        record = {"id": key, "image": path, "style": style}
+        try:
+            record.update(process(path, style, seed, key, out_dir, with_products))
+            record["status"] = "ok"
+        except Exception as e:
+            record.update({"status": "failed", "error": f"{type(e).__name__}: {e}"})
+        record["duration_s"] = round(time.perf_counter() - started, 3)
+        writer.write(record)
+        return record
+
+    def report(record):
+        counts[record["status"]] += 1
+        done = counts["ok"] + counts["failed"] + counts["skipped"]
+        detail = f"{len(record.get('new_items', []))} new items" if record["status"] == "ok" else record["error"]
+        logger.info("[%d/%d] %s %s × %s (%.1fs) %s", done, total, record["status"], record["image"],
+                    record["style"], record["duration_s"], detail)
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch") as executor:
+            in_flight = set()
+            try:
+                for path, style in pairs:
+                    # Without a fixed seed the id is keyed on the path; the seed is derived from the pixels.
+                    key = item_id(path, style, seed)
+                    if key in finished:
+                        counts["skipped"] += 1
+                        continue
+                    # Submit lazily so a huge batch never holds more than a few decoded images.
+                    if len(in_flight) >= concurrency * 2:
+                        done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            report(future.result())
+                    in_flight.add(executor.submit(task, path, style, key))
+                for future in wait(in_flight).done:
+                    report(future.result())
+            except KeyboardInterrupt:
+                for future in in_flight:
+                    future.cancel()
+                raise
+    finally:
+        writer.close()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("source", help="directory of images or manifest file")
+    parser.add_argument("--style", action="append", default=[], help="style to apply (repeatable)")
+    parser.add_argument("--styles-file", help="file with one style per line")
+    parser.add_argument("--out", default="redesigns", help="output directory for renders and manifest.jsonl")
+    parser.add_argument("--concurrency", type=int, default=2, help="items processed at once")
+    parser.add_argument("--seed", type=int, help="fixed seed for every item (default: derived per image and style)")
+    parser.add_argument("--no-products", action="store_true", help="skip the product search")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    styles = list(args.style)
+    if args.styles_file:
+        with open(args.styles_file, encoding="utf-8") as f:
+            styles.extend(line.strip() for line in f if line.strip())
+
+    pairs = discover(args.source, styles)
+    if not pairs:
+        parser.error("nothing to do: no images found, or no --style given for entries without one")
+
+    counts = run_batch(pairs, args.out, max(1, args.concurrency), args.seed, not args.no_products)
+    logger.info("done: %(ok)d ok, %(failed)d failed, %(skipped)d already finished", counts)
+    if counts["failed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
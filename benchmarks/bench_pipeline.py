@@ -0,0 +1,203 @@
+"""
+Per-stage benchmarks for the redesign pipeline against the local mock
+backends: image decode/encode, Vision round trips, prompt building, SDXL
+generation, product fan-out, chat and a full Generate Redesign run.
+
+    python -m benchmarks.bench_pipeline --iterations 20 --latency-scale 0.1
+    python -m benchmarks.bench_pipeline --save-baseline benchmarks/baselines/local.json
+    python -m benchmarks.bench_pipeline --baseline benchmarks/baselines/local.json
+
+Every iteration uses a fresh image and fresh product keywords, so the
+caches are exercised on a miss unless a stage says otherwise.
+"""
+import argparse
+import io
+import itertools
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from benchmarks.mock_backends import MockBackends, add_mock_arguments, config_from_args
+
+PRODUCT_KEYWORDS = ["Couch", "Lamp", "Cushion", "Rug", "Houseplant"]
+STYLE = "Japandi, warm oak and linen"
+
+_counter = itertools.count()
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    k = (len(ordered) - 1) * p / 100
+    lo, hi = math.floor(k), math.ceil(k)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def synthetic_room(width, height):
+    """A noisy gradient photo stand-in; each call differs by one pixel so content hashes never collide."""
+    noise = Image.effect_noise((width, height), 48)
+    gradient = Image.linear_gradient("L").resize((width, height))
+    image = Image.merge("RGB", (noise, gradient, Image.blend(noise, gradient, 0.5)))
+    n = next(_counter)
+    image.putpixel((n % width, (n // width) % height), (n % 256, 0, 0))
+    return image
+
+
+def measure(stage, iterations, concurrency=1, warmup=1):
+    """`stage` is (setup, run): setup() builds the input outside the timed region, run(input) is timed."""
+    setup, run = stage
+    for _ in range(warmup):
+        run(setup())
+    inputs = [setup() for _ in range(iterations)]
+    samples = []
+
+    def timed(value):
+        started = time.perf_counter()
+        run(value)
+        samples.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(timed, inputs))
+    else:
+        for value in inputs:
+            timed(value)
+    wall = time.perf_counter() - started
+    return {
+        "iterations": iterations,
+        "concurrency": concurrency,
+        "mean": sum(samples) / len(samples),
+        "p50": percentile(samples, 50),
+        "p90": percentile(samples, 90),
+        "p99": percentile(samples, 99),
+        "throughput": iterations / wall if wall else 0.0,
+    }
+
+
+def build_stages(size):
+    # Imported here so the mock environment is in place before the modules read it.
+    from modules import image_processor, product_search, redesign, chat_assistant, display, vision_payload, ingest
+
+    width, height = size
+    upload = io.BytesIO()
+    synthetic_room(width, height).save(upload, format="JPEG", quality=90)
+    upload_bytes = upload.getvalue()
+    analysis = image_processor.image_to_text_google_vision(synthetic_room(640, 480))
+    keywords = itertools.count()
+
+    def room():
+        return synthetic_room(width, height)
+
+    def room_pair():
+        return synthetic_room(width, height), synthetic_room(width, height)
+
+    def fresh_keywords():
+        n = next(keywords)
+        return [f"{k} {n}" for k in PRODUCT_KEYWORDS]
+
+    def nothing():
+        return None
+
+    def full_redesign(image):
+        result = redesign.run_redesign(image, STYLE, seed=1)
+        n = next(keywords)
+        items = result["new_items"] or PRODUCT_KEYWORDS[:2]
+        list(product_search.fetch_products_concurrently([f"{item} {n}" for item in items]))
+
+    def chat_stream(_):
+        for _ in chat_assistant.stream_chat_with_groq("How do I make this room feel warmer?", []):
+            pass
+
+    return {
+        "decode_upload": (nothing, lambda _: ingest.ingest(upload_bytes)),
+        "vision_encode": (room, lambda image: vision_payload.encode_for_vision(
+            image, image_processor.ANALYSIS_FEATURES, f"bench-{next(_counter)}")),
+        "display_encode": (room, display.preview_bytes),
+        "vision_analysis": (room, image_processor.image_to_text_google_vision),
+        "vision_labels_pair": (room_pair, lambda pair: redesign.detect_labels_many(list(pair))),
+        "region_diff": (room_pair, lambda pair: redesign.detect_new_items(*pair)),
+        "prompt_build": (nothing, lambda _: image_processor.generate_powerful_prompt(analysis, STYLE)),
+        "generate": (room, lambda image: image_processor.generate_high_quality_image(image, STYLE, seed=1)),
+        "product_fanout": (fresh_keywords, lambda kws: list(product_search.fetch_products_concurrently(kws))),
+        "chat": (nothing, lambda _: chat_assistant.chat_with_groq("How do I make this room feel warmer?", [])),
+        "chat_stream": (nothing, chat_stream),
+        "full_redesign": (room, full_redesign),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Prints p50/p90 changes against a baseline; returns the names of regressed stages."""
+    regressed = []
+    print(f"\n{'stage':<20} {'p50 Δ':>9} {'p90 Δ':>9}")
+    for name, stats in results.items():
+        if name not in baseline:
+            continue
+        deltas = [
+            (stats[key] - baseline[name][key]) / baseline[name][key] if baseline[name][key] else 0.0
+            for key in ("p50", "p90")
+        ]
+        flag = "  REGRESSION" if max(deltas) > tolerance else ""
+        if flag:
+            regressed.append(name)
+        print(f"{name:<20} {deltas[0]:>+9.1%} {deltas[1]:>+9.1%}{flag}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=1, help="parallel calls per stage, for throughput")
+    parser.add_argument("--stages", help="comma-separated subset of stages to run")
+    parser.add_argument("--size", default="4032x3024", help="synthetic upload size, WIDTHxHEIGHT")
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--save-baseline", help="store results as a baseline file")
+    parser.add_argument("--baseline", help="compare against a baseline file")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed p50/p90 slowdown before flagging")
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    mocks = MockBackends(config_from_args(args), seed=0).start()
+    scratch = tempfile.mkdtemp(prefix="bench-")
+    os.environ.update(mocks.env())
+    os.environ.update({"CACHE_DIR": scratch, "PRODUCT_DB_PATH": os.path.join(scratch, "products.sqlite3")})
+    os.environ.setdefault("TRACE_LOG", "0")  # keep span logging out of the timings unless asked for
+    for name in ("VISION", "HF", "SERPAPI", "GROQ"):
+        # Measure the pipeline, not the rate limits sized for the real APIs.
+        os.environ.setdefault(f"GOVERNOR_{name}_RPS", "1000")
+        os.environ.setdefault(f"GOVERNOR_{name}_BURST", "1000")
+
+    size = tuple(int(v) for v in args.size.lower().split("x"))
+    stages = build_stages(size)
+    selected = args.stages.split(",") if args.stages else list(stages)
+
+    results = {}
+    print(f"{'stage':<20} {'mean':>8} {'p50':>8} {'p90':>8} {'p99':>8} {'ops/s':>8}")
+    for name in selected:
+        stats = measure(stages[name], args.iterations, args.concurrency)
+        results[name] = stats
+        print(f"{name:<20} {stats['mean']:>8.3f} {stats['p50']:>8.3f} {stats['p90']:>8.3f} "
+              f"{stats['p99']:>8.3f} {stats['throughput']:>8.2f}")
+    print(f"\nmock upstream calls: {mocks.calls}")
+    mocks.stop()
+
+    report = {"size": args.size, "concurrency": args.concurrency, "stages": results}
+    for path in filter(None, (args.json, args.save_baseline)):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)["stages"]
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,335 @@
+"""
+Concurrent-session load test: simulated users drive app.py through
+Streamlit's AppTest against the local mock backends. Each user uploads a
+photo, clicks Generate Redesign and waits for the result page (with its
+product recommendations), then opens the chat and asks a question, with
+think times in between.
+
+    python -m benchmarks.load_test --users 1,2,4,8,16 --latency-scale 0.2
+    python -m benchmarks.load_test --users 8 --journeys 3 --think 5 --json load.json
+
+Every user runs in this one process, as the sessions of one `streamlit
+run app.py` would, so the job pool, governor, caches and image store are
+shared. AppTest has no file_uploader support, so st.file_uploader is
+replaced by a stand-in that returns the session's synthetic upload.
+AppTest also ignores run_every, so users poll their job by rerunning the
+whole script once a second. A poll costs more than the fragment rerun a
+browser triggers, so the numbers err on the slow side.
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from benchmarks.bench_pipeline import STYLE, percentile, synthetic_room
+from benchmarks.mock_backends import MockBackends, add_mock_arguments, config_from_args
+
+logger = logging.getLogger(__name__)
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+UPLOAD_KEY = "_load_test_upload"
+POLL_INTERVAL = 1.0  # job_progress's run_every
+CHAT_MESSAGE = "How do I make this room feel warmer?"
+STEPS = ("upload", "generate", "result", "chat")
+# Thread name prefixes of the app's own pools, counted apart from Streamlit's and the harness's.
+WORKER_PREFIXES = ("generation", "product-search", "product-refresh", "prefetch", "http-hedge")
+
+
+def install_upload_stand_in():
+    """Makes st.file_uploader return whatever the harness put in the session's UPLOAD_KEY."""
+    import streamlit as st
+
+    def file_uploader(label, *args, **kwargs):
+        return st.session_state.get(UPLOAD_KEY)
+
+    st.file_uploader = file_uploader
+
+
+def share_test_runtime():
+    """
+    AppTest installs a mock Runtime and sets global.appTest for the length
+    of each run, then clears both, which breaks scripts still running in
+    other sessions. Keep the most recent runtime visible to all of them and
+    the option on for the whole test.
+    """
+    from streamlit import config
+    from streamlit.runtime import Runtime
+
+    config.set_option("global.appTest", True)
+
+    latest = {}
+
+    def instance(cls):
+        if cls._instance is not None:
+            latest["runtime"] = cls._instance
+        runtime = cls._instance or latest.get("runtime")
+        if runtime is None:
+            raise RuntimeError("Runtime hasn't been created!")
+        return runtime
+
+    Runtime.instance = classmethod(instance)
+    Runtime.exists = classmethod(lambda cls: cls._instance is not None or "runtime" in latest)
+
+
+def make_upload(size):
+    from streamlit.proto.Common_pb2 import FileURLs
+    from streamlit.runtime.uploaded_file_manager import UploadedFile, UploadedFileRec
+
+    buff = io.BytesIO()
+    synthetic_room(*size).save(buff, format="JPEG", quality=90)
+    return UploadedFile(UploadedFileRec(uuid.uuid4().hex, "room.jpg", "image/jpeg", buff.getvalue()), FileURLs())
+
+
+def rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # KB on Linux
+
+
+class Sampler(threading.Thread):
+    """Tracks peak RSS and thread counts of the process while a level runs."""
+
+    def __init__(self, interval=0.1):
+        super().__init__(daemon=True, name="load-sampler")
+        self.interval = interval
+        self.baseline_rss = rss_bytes()
+        self.peak_rss = self.baseline_rss
+        self.peak_threads = threading.active_count()
+        self.peak_workers = 0
+        self._stop_event = threading.Event()
+
+    def sample(self):
+        threads = threading.enumerate()
+        self.peak_rss = max(self.peak_rss, rss_bytes())
+        self.peak_threads = max(self.peak_threads, len(threads))
+        self.peak_workers = max(self.peak_workers, sum(t.name.startswith(WORKER_PREFIXES) for t in threads))
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.sample()
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = {step: [] for step in STEPS}
+        self.completed = 0
+        self.errors = Counter()
+        self._lock = threading.Lock()
+
+    def add(self, step, seconds):
+        with self._lock:
+            self.samples[step].append(seconds)
+
+    def fail(self, step, message):
+        with self._lock:
+            self.errors[f"{step}: {message[:120]}"] += 1
+
+    def done(self):
+        with self._lock:
+            self.completed += 1
+
+
+class JourneyFailed(Exception):
+    def __init__(self, step, message):
+        self.step = step
+        super().__init__(message)
+
+
+def _state(at, key, default=None):
+    return at.session_state[key] if key in at.session_state else default
+
+
+def _button(at, label):
+    return next(b for b in at.button if b.label == label)
+
+
+def _run(at, step, record, action=None):
+    """Runs the script (after `action`, e.g. a click) and records how long the rerun took."""
+    started = time.perf_counter()
+    (action or at).run()
+    elapsed = time.perf_counter() - started
+    if at.exception:
+        raise JourneyFailed(step, at.exception[0].message)
+    return elapsed
+
+
+def journey(upload, rng, think, timeout, record):
+    from streamlit.testing.v1 import AppTest
+
+    def pause(scale=1.0):
+        time.sleep(rng.uniform(0.5, 1.5) * think * scale)
+
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+    at.session_state[UPLOAD_KEY] = upload
+    record.add("upload", _run(at, "upload", record))
+    if _state(at, "orig_handle") is None:
+        raise JourneyFailed("upload", "; ".join(e.value for e in at.error) or "upload was not stored")
+
+    pause()
+    next(w for w in at.text_input if w.label.startswith("🎨")).input(STYLE)
+    started = time.perf_counter()
+    _run(at, "generate", record, _button(at, "✨ Generate Redesign").click())
+    result = None
+    while _state(at, "job_id"):
+        if time.perf_counter() - started > timeout:
+            raise JourneyFailed("generate", f"no result after {timeout:.0f}s")
+        time.sleep(POLL_INTERVAL)
+        # The poll that sees the job finish also renders the result page and its products.
+        result = _run(at, "generate", record)
+    if _state(at, "stylized_handle") is None:
+        messages = [e.value for e in at.error] + [w.value for w in at.warning]
+        raise JourneyFailed("generate", "; ".join(messages) or "no redesign in session state")
+    record.add("generate", time.perf_counter() - started)
+    if result is not None:
+        record.add("result", result)
+
+    pause()
+    _run(at, "chat", record, _button(at, "💬 Chat with Assistant").click())
+    pause(0.5)
+    record.add("chat", _run(at, "chat", record, at.text_input(key="chat_input").input(CHAT_MESSAGE)))
+    reply = _state(at, "chat_history", [])[-1:]
+    if not reply or reply[0]["role"] != "assistant" or reply[0]["content"].startswith("⚠"):
+        raise JourneyFailed("chat", reply[0]["content"] if reply else "no reply")
+
+
+def simulate_user(index, uploads, args, record):
+    rng = random.Random(index)
+    # Spread arrivals over the ramp so the first requests don't land in one burst.
+    time.sleep(args.ramp * index / max(args.users_now, 1))
+    for upload in uploads:
+        try:
+            journey(upload, rng, args.think, args.timeout, record)
+        except JourneyFailed as e:
+            record.fail(e.step, str(e))
+        except Exception as e:
+            logger.exception("Journey of user %d failed in the harness", index)
+            record.fail("harness", f"{type(e).__name__}: {e}")
+        else:
+            record.done()
+
+
+def run_level(users, args):
+    from modules import governor
+
+    uploads = [[make_upload(args.size) for _ in range(args.journeys)] for _ in range(users)]
+    args.users_now = users
+    record = Recorder()
+    waits_before = sum(s["wait_seconds"] for s in governor.stats().values())
+    sampler = Sampler()
+    sampler.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=users, thread_name_prefix="load-user") as executor:
+        for future in [executor.submit(simulate_user, i, uploads[i], args, record) for i in range(users)]:
+            future.result()
+    wall = time.perf_counter() - started
+    sampler.stop()
+
+    steps = {}
+    for step, samples in record.samples.items():
+        steps[step] = {
+            "count": len(samples),
+            "p50": percentile(samples, 50),
+            "p90": percentile(samples, 90),
+            "p99": percentile(samples, 99),
+            "max": max(samples, default=0.0),
+        }
+    return {
+        "users": users,
+        "journeys": record.completed,
+        "failed": sum(record.errors.values()),
+        "wall_seconds": wall,
+        "journeys_per_minute": record.completed / wall * 60 if wall else 0.0,
+        "steps": steps,
+        "rss_mb": sampler.baseline_rss / 1e6,
+        "peak_rss_mb": sampler.peak_rss / 1e6,
+        "peak_threads": sampler.peak_threads,
+        "peak_worker_threads": sampler.peak_workers,
+        "governor_wait_seconds": sum(s["wait_seconds"] for s in governor.stats().values()) - waits_before,
+        "errors": dict(record.errors.most_common(5)),
+    }
+
+
+def print_level(level):
+    steps = level["steps"]
+    print(
+        f"{level['users']:>5} {level['journeys']:>5} {level['failed']:>5} {level['journeys_per_minute']:>8.1f} "
+        f"{steps['upload']['p50']:>7.2f} {steps['upload']['p90']:>7.2f} "
+        f"{steps['generate']['p50']:>7.2f} {steps['generate']['p90']:>7.2f} {steps['generate']['p99']:>7.2f} "
+        f"{steps['chat']['p50']:>7.2f} {steps['chat']['p90']:>7.2f} "
+        f"{level['peak_rss_mb']:>8.0f} {level['peak_threads']:>7} {level['peak_worker_threads']:>7} "
+        f"{level['governor_wait_seconds']:>7.1f}"
+    )
+    for message, count in level["errors"].items():
+        print(f"      {count}× {message}")
+
+
+def scaling_limit(levels):
+    """First user count where adding users stopped adding throughput (<10% gain), or None."""
+    for previous, level in zip(levels, levels[1:]):
+        if level["journeys_per_minute"] < previous["journeys_per_minute"] * 1.1 or level["failed"]:
+            return previous["users"]
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", default="1,4,8", help="comma-separated concurrent user counts to sweep")
+    parser.add_argument("--journeys", type=int, default=1, help="upload → generate → chat journeys per user")
+    parser.add_argument("--think", type=float, default=2.0, help="mean think time between steps, in seconds")
+    parser.add_argument("--ramp", type=float, default=2.0, help="seconds over which users arrive")
+    parser.add_argument("--timeout", type=float, default=180.0, help="longest a single step may take")
+    parser.add_argument("--size", default="4032x3024", help="synthetic upload size, WIDTHxHEIGHT")
+    parser.add_argument("--json", help="write results to this file")
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+    args.size = tuple(int(v) for v in args.size.lower().split("x"))
+
+    mocks = MockBackends(config_from_args(args), seed=0).start()
+    scratch = tempfile.mkdtemp(prefix="load-")
+    os.environ.update(mocks.env())
+    os.environ.update({"CACHE_DIR": scratch, "PRODUCT_DB_PATH": os.path.join(scratch, "products.sqlite3")})
+    os.environ.setdefault("TRACE_LOG", "0")
+    for name in ("VISION", "HF", "SERPAPI", "GROQ"):
+        # Find the app's own limit first; set these to the real API limits to include them.
+        os.environ.setdefault(f"GOVERNOR_{name}_RPS", "1000")
+        os.environ.setdefault(f"GOVERNOR_{name}_BURST", "1000")
+    install_upload_stand_in()
+    share_test_runtime()
+
+    levels = []
+    print(f"{'users':>5} {'done':>5} {'fail':>5} {'jrn/min':>8} "
+          f"{'up p50':>7} {'up p90':>7} {'gen p50':>7} {'gen p90':>7} {'gen p99':>7} "
+          f"{'chat50':>7} {'chat90':>7} {'RSS MB':>8} {'threads':>7} {'workers':>7} {'queued':>7}")
+    for users in (int(u) for u in args.users.split(",")):
+        level = run_level(users, args)
+        levels.append(level)
+        print_level(level)
+    print(f"\nmock upstream calls: {mocks.calls}")
+    limit = scaling_limit(levels)
+    if limit is not None:
+        print(f"throughput stopped scaling beyond {limit} concurrent users")
+    mocks.stop()
+
+    if args.json:
+        os.makedirs(os.path.dirname(args.json) or ".", exist_ok=True)
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"size": "x".join(map(str, args.size)), "levels": levels}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
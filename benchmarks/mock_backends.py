@@ -0,0 +1,276 @@
+"""
+Local stand-ins for Google Vision, the Hugging Face SDXL endpoint, SerpAPI
+and Groq. They replay the responses under benchmarks/recordings with
+configurable latency, error rate and payload size, so the pipeline can be
+benchmarked and load-tested offline.
+
+    python -m benchmarks.mock_backends --port 8765 --latency vision=0.4 --latency hf=6
+
+prints the environment variables that point the app at the stand-ins.
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+from PIL import Image
+
+RECORDINGS_DIR = os.path.join(os.path.dirname(__file__), "recordings")
+RECORDED_RENDER = os.path.join(os.path.dirname(os.path.dirname(__file__)), "RedesignedRoom.png")
+
+# Per-backend behaviour. latency is (mean, jitter) in seconds; error_rate is
+# the share of calls answered with error_status; payload_scale multiplies the
+# replayed payload (result lists for JSON, pixel count for images).
+DEFAULT_CONFIG = {
+    "vision": {"latency": (0.35, 0.15), "error_rate": 0.0, "error_status": 503, "payload_scale": 1.0},
+    "hf": {"latency": (6.0, 2.0), "error_rate": 0.0, "error_status": 503, "payload_scale": 1.0},
+    "serpapi": {"latency": (1.2, 0.6), "error_rate": 0.0, "error_status": 429, "payload_scale": 1.0},
+    # For streaming chat, latency is time to first token; token_interval paces the rest.
+    "groq": {"latency": (0.3, 0.1), "error_rate": 0.0, "error_status": 429, "payload_scale": 1.0,
+             "token_interval": 0.02},
+}
+
+
+def _load(name):
+    with open(os.path.join(RECORDINGS_DIR, name), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _scale_list(items, scale):
+    if scale <= 1.0:
+        return items[:max(1, int(len(items) * scale))]
+    return [items[i % len(items)] for i in range(int(len(items) * scale))]
+
+
+class MockBackends:
+    def __init__(self, config=None, seed=None):
+        self.config = {name: dict(DEFAULT_CONFIG[name], **(config or {}).get(name, {})) for name in DEFAULT_CONFIG}
+        self.vision = _load("vision.json")["variants"]
+        self.serpapi = _load("serpapi.json")
+        self.groq = _load("groq.json")
+        self.random = random.Random(seed)
+        self.calls = {name: 0 for name in DEFAULT_CONFIG}
+        self._renders = {}
+        self._lock = threading.Lock()
+        self.server = None
+
+    def delay(self, backend):
+        mean, jitter = self.config[backend]["latency"]
+        with self._lock:
+            self.calls[backend] += 1
+            wait = max(0.0, self.random.gauss(mean, jitter)) if jitter else mean
+            failed = self.random.random() < self.config[backend]["error_rate"]
+        time.sleep(wait)
+        return failed
+
+    def vision_response(self, body):
+        scale = self.config["vision"]["payload_scale"]
+        responses = []
+        for request in body.get("requests", []):
+            # Pick a recorded variant from the image content so the same image always gets the same answer.
+            digest = hashlib.sha256(request["image"]["content"].encode()).digest()
+            variant = self.vision[digest[0] % len(self.vision)]
+            requested = {f["type"] for f in request.get("features", [])}
+            response = {}
+            if "LABEL_DETECTION" in requested and "labelAnnotations" in variant:
+                response["labelAnnotations"] = _scale_list(variant["labelAnnotations"], scale)
+            if "OBJECT_LOCALIZATION" in requested and "localizedObjectAnnotations" in variant:
+                response["localizedObjectAnnotations"] = _scale_list(variant["localizedObjectAnnotations"], scale)
+            if "IMAGE_PROPERTIES" in requested and "imagePropertiesAnnotation" in variant:
+                response["imagePropertiesAnnotation"] = variant["imagePropertiesAnnotation"]
+            if "TEXT_DETECTION" in requested and "textAnnotations" in variant:
+                response["textAnnotations"] = variant["textAnnotations"]
+            responses.append(response)
+        return {"responses": responses}
+
+    def render(self, width, height):
+        scale = self.config["hf"]["payload_scale"]
+        size = (max(16, int(width * scale ** 0.5)), max(16, int(height * scale ** 0.5)))
+        with self._lock:
+            if size not in self._renders:
+                image = Image.open(RECORDED_RENDER).convert("RGB").resize(size)
+                buff = io.BytesIO()
+                image.save(buff, format="JPEG", quality=90)
+                self._renders[size] = buff.getvalue()
+            return self._renders[size]
+
+    def start(self, host="127.0.0.1", port=0):
+        backends = self
+
+        class Handler(_Handler):
+            mocks = backends
+
+        self.server = _Server((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True, name="mock-backends").start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def env(self) -> dict:
+        """Environment that points the app modules at these stand-ins (set before importing them)."""
+        return {
+            "VISION_API_URL": f"{self.base_url}/v1/images:annotate",
+            "SDXL_API_URL": f"{self.base_url}/models/stabilityai/stable-diffusion-xl-base-1.0",
+            "SERPAPI_URL": f"{self.base_url}/search",
+            "GROQ_API_URL": f"{self.base_url}/openai/v1/chat/completions",
+            "GOOGLE_VISION_API_KEY": "mock",
+            "HF_TOKEN": "mock",
+            "SERPAPI_API_KEY": "mock",
+            "GROQ_API_KEY": "mock",
+        }
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients dropping pooled keep-alive connections is routine here.
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    mocks = None
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body, content_type="application/json", headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, backend):
+        status = self.mocks.config[backend]["error_status"]
+        if backend == "hf" and status == 503:
+            self._send(503, {"error": "Model is currently loading", "estimated_time": 1.0})
+        else:
+            self._send(status, {"error": {"code": status, "message": f"mock {backend} error"}}, headers={"Retry-After": "1"})
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_GET(self):
+        if urlsplit(self.path).path != "/search":
+            return self._send(404, {"error": "not found"})
+        if self.mocks.delay("serpapi"):
+            return self._error("serpapi")
+        data = dict(self.mocks.serpapi)
+        data["organic_results"] = _scale_list(data["organic_results"], self.mocks.config["serpapi"]["payload_scale"])
+        self._send(200, data)
+
+    def do_POST(self):
+        path = urlsplit(self.path).path
+        body = self._body()
+        if path == "/v1/images:annotate":
+            if self.mocks.delay("vision"):
+                return self._error("vision")
+            return self._send(200, self.mocks.vision_response(body))
+        if path.startswith("/models/"):
+            if self.mocks.delay("hf"):
+                return self._error("hf")
+            params = body.get("parameters", {})
+            return self._send(200, self.mocks.render(params.get("width", 1024), params.get("height", 1024)), "image/jpeg")
+        if path == "/openai/v1/chat/completions":
+            if self.mocks.delay("groq"):
+                return self._error("groq")
+            if body.get("stream"):
+                return self._stream_chat()
+            return self._send(200, self.mocks.groq)
+        self._send(404, {"error": "not found"})
+
+    def _stream_chat(self):
+        content = self.mocks.groq["choices"][0]["message"]["content"]
+        interval = self.mocks.config["groq"]["token_interval"]
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def chunk(data: bytes):
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+
+        words = content.split(" ")
+        for i, word in enumerate(words):
+            delta = word if i == 0 else " " + word
+            event = {"choices": [{"index": 0, "delta": {"content": delta}}]}
+            chunk(f"data: {json.dumps(event)}\n\n".encode())
+            time.sleep(interval)
+        chunk(b"data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+
+def parse_overrides(pairs, cast=float):
+    """Parses repeated backend=value options, e.g. ["vision=0.4", "hf=6"]."""
+    overrides = {}
+    for pair in pairs or []:
+        backend, value = pair.split("=", 1)
+        overrides[backend] = cast(value)
+    return overrides
+
+
+def config_from_args(args) -> dict:
+    config = {name: {} for name in DEFAULT_CONFIG}
+    if args.latency_scale != 1.0:
+        for name, defaults in DEFAULT_CONFIG.items():
+            mean, jitter = defaults["latency"]
+            config[name]["latency"] = (mean * args.latency_scale, jitter * args.latency_scale)
+        config["groq"]["token_interval"] = DEFAULT_CONFIG["groq"]["token_interval"] * args.latency_scale
+    for backend, value in parse_overrides(args.latency).items():
+        config[backend]["latency"] = (value * args.latency_scale, value * args.latency_scale * 0.3)
+    for backend, value in parse_overrides(args.error_rate).items():
+        config[backend]["error_rate"] = value
+    for backend, value in parse_overrides(args.payload_scale).items():
+        config[backend]["payload_scale"] = value
+    return config
+
+
+def add_mock_arguments(parser):
+    parser.add_argument("--latency", action="append", metavar="BACKEND=SECONDS", help="mean latency per backend")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="multiply every backend latency")
+    parser.add_argument("--error-rate", action="append", metavar="BACKEND=FRACTION", help="share of failing calls")
+    parser.add_argument("--payload-scale", action="append", metavar="BACKEND=FACTOR", help="scale replayed payloads")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    mocks = MockBackends(config_from_args(args)).start(args.host, args.port)
+    for key, value in mocks.env().items():
+        print(f"export {key}={value}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        mocks.stop()
+
+
+if __name__ == "__main__":
+    main()
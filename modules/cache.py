@@ -0,0 +1,200 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FuturesTimeout
+from PIL import Image
+from modules import deadline
+
+logger = logging.getLogger(__name__)
+
+CACHE_ROOT = os.getenv("CACHE_DIR", ".cache")
+# Eviction frees the disk tier down to this fraction of its limit, so the
+# directory is only rescanned every few writes once the cache is full.
+DISK_LOW_WATER = 0.9
+
+
+def image_digest(image: Image.Image) -> str:
+    """Content hash of the decoded pixels, independent of file format or name."""
+    h = hashlib.sha256()
+    h.update(f"{image.mode}:{image.width}x{image.height}:".encode())
+    h.update(image.tobytes())
+    return h.hexdigest()
+
+
+def make_key(*parts) -> str:
+    raw = json.dumps(parts, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class TieredCache:
+    """
+    Two-tier cache: an in-memory LRU in front of a directory of files with
+    size-based eviction (least recently used files go first). Values are
+    serialized with `dumps`/`loads` for the disk tier, JSON by default.
+    """
+
+    def __init__(self, name, max_entries=256, max_disk_bytes=64 * 1024 * 1024,
+                 cache_dir=None, dumps=None, loads=None):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.cache_dir = cache_dir or os.path.join(CACHE_ROOT, name)
+        self._dumps = dumps or (lambda v: json.dumps(v).encode())
+        self._loads = loads or (lambda b: json.loads(b.decode()))
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        self._cost_total = 0.0
+        self._cost_count = 0
+        self._disk_bytes = None  # running size of the disk tier, seeded from disk on the first write
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _remember(self, key, value):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self._counters["memory_hits"] += 1
+                return self._memory[key]
+
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                value = self._loads(f.read())
+            os.utime(path)  # mtime doubles as the disk tier's LRU clock
+        except (OSError, ValueError):
+            with self._lock:
+                self._counters["misses"] += 1
+            return None
+
+        with self._lock:
+            self._counters["disk_hits"] += 1
+            self._remember(key, value)
+        return value
+
+    def put(self, key, value, cost=None):
+        """Store `value`; `cost` is the upstream latency in seconds it took to produce."""
+        with self._lock:
+            self._remember(key, value)
+            self._counters["stores"] += 1
+            if cost is not None:
+                self._cost_total += cost
+                self._cost_count += 1
+
+        if self.max_disk_bytes <= 0:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            path = self._path(key)
+            data = self._dumps(value)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            try:
+                replaced = os.stat(path).st_size
+            except OSError:
+                replaced = 0
+            os.replace(tmp_path, path)
+            seeded = self._scan_disk()[1] if self._disk_bytes is None else None
+            with self._lock:
+                if seeded is not None:
+                    self._disk_bytes = seeded
+                else:
+                    self._disk_bytes += len(data) - replaced
+                over = self._disk_bytes > self.max_disk_bytes
+            if over:
+                self._evict_disk()
+        except OSError as e:
+            logger.warning("%s cache: disk write failed: %s", self.name, e)
+
+    def _scan_disk(self):
+        """(entries, total bytes) of the disk tier, entries as (mtime, size, path)."""
+        entries = []
+        total = 0
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if not entry.is_file() or entry.name.endswith(".tmp"):
+                    continue
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+        return entries, total
+
+    def _evict_disk(self):
+        # Rescan rather than trust the running total: other processes may share the directory.
+        entries, total = self._scan_disk()
+        target = self.max_disk_bytes * DISK_LOW_WATER if total > self.max_disk_bytes else total
+        for _, size, path in sorted(entries):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            with self._lock:
+                self._counters["evictions"] += 1
+        with self._lock:
+            self._disk_bytes = total
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._counters)
+            hits = stats["memory_hits"] + stats["disk_hits"]
+            lookups = hits + stats["misses"]
+            avg_cost = self._cost_total / self._cost_count if self._cost_count else 0.0
+            stats.update({
+                "hits": hits,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "saved_seconds": hits * avg_cost,
+            })
+        return stats
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls for the same key into one: the first caller
+    runs `fn`, later callers arriving while it is in flight wait for and
+    share its result (or exception). Waiting callers give up with
+    DeadlineExceeded when their own request deadline passes.
+    """
+
+    def __init__(self):
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+        if not owner:
+            try:
+                return future.result(timeout=deadline.clamp(None))
+            except FuturesTimeout:
+                if future.done():
+                    raise
+                raise deadline.DeadlineExceeded(f"Timed out waiting for an in-flight call for {key}") from None
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._inflight[key]
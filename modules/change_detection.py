@@ -0,0 +1,133 @@
+import os
+from collections import deque
+import numpy as np
+from PIL import Image
+from modules import tracing
+
+# Both images are compared at this size, in cells of CELL_SIZE pixels.
+DIFF_WORK_EDGE = int(os.getenv("DIFF_WORK_EDGE", "256"))
+CELL_SIZE = 8
+# A cell counts as changed when its mean difference (0-255) is above this
+# floor and DIFF_SIGMA standard deviations above the image-wide mean; SDXL
+# repaints every pixel slightly, so only the outliers are real edits.
+DIFF_THRESHOLD = float(os.getenv("DIFF_THRESHOLD", "24"))
+DIFF_SIGMA = float(os.getenv("DIFF_SIGMA", "1.0"))
+MIN_REGION_CELLS = 3
+MAX_REGIONS = int(os.getenv("DIFF_MAX_REGIONS", "6"))
+REGION_PADDING = 0.03  # share of the image added around each region
+
+
+def _as_array(image: Image.Image, size) -> np.ndarray:
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    return np.asarray(image.resize(size, Image.BOX), dtype=np.float32)
+
+
+def cell_scores(before: Image.Image, after: Image.Image) -> np.ndarray:
+    """Mean absolute RGB difference per cell, comparing both images at the same working size."""
+    scale = DIFF_WORK_EDGE / max(after.width, after.height)
+    cols = max(1, round(after.width * scale / CELL_SIZE))
+    rows = max(1, round(after.height * scale / CELL_SIZE))
+    size = (cols * CELL_SIZE, rows * CELL_SIZE)
+
+    diff = np.abs(_as_array(after, size) - _as_array(before, size)).mean(axis=2)
+    return diff.reshape(rows, CELL_SIZE, cols, CELL_SIZE).mean(axis=(1, 3))
+
+
+def _components(mask: np.ndarray) -> list:
+    """4-connected components of a boolean cell grid, as lists of (row, col)."""
+    seen = np.zeros_like(mask)
+    rows, cols = mask.shape
+    components = []
+    for start in zip(*np.nonzero(mask)):
+        if seen[start]:
+            continue
+        seen[start] = True
+        queue, cells = deque([start]), []
+        while queue:
+            r, c = queue.popleft()
+            cells.append((r, c))
+            for nr, nc in ((r - 1, c), (r + 1, c), (r, c - 1), (r, c + 1)):
+                if 0 <= nr < rows and 0 <= nc < cols and mask[nr, nc] and not seen[nr, nc]:
+                    seen[nr, nc] = True
+                    queue.append((nr, nc))
+        components.append(cells)
+    return components
+
+
+def _overlaps(a, b) -> bool:
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def _merge(regions: list) -> list:
+    """Merges overlapping (box, score) regions until none overlap."""
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(regions)):
+            for j in range(i + 1, len(regions)):
+                (a, sa), (b, sb) = regions[i], regions[j]
+                if _overlaps(a, b):
+                    box = (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+                    regions[i] = (box, sa + sb)
+                    del regions[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return regions
+
+
+def changed_regions(before: Image.Image, after: Image.Image, max_regions=MAX_REGIONS) -> list:
+    """
+    Regions where `after` differs from `before`, strongest first, as dicts
+    with a normalized "box" (x0, y0, x1, y1) and a "score" (summed cell
+    difference). The images may differ in size; they are compared on the
+    same normalized grid.
+    """
+    with tracing.span("diff.regions") as current:
+        scores = cell_scores(before, after)
+        threshold = max(DIFF_THRESHOLD, float(scores.mean() + DIFF_SIGMA * scores.std()))
+        rows, cols = scores.shape
+
+        regions = []
+        for cells in _components(scores > threshold):
+            if len(cells) < MIN_REGION_CELLS:
+                continue
+            rs, cs = zip(*cells)
+            box = (
+                max(0.0, float(min(cs)) / cols - REGION_PADDING),
+                max(0.0, float(min(rs)) / rows - REGION_PADDING),
+                min(1.0, float(max(cs) + 1) / cols + REGION_PADDING),
+                min(1.0, float(max(rs) + 1) / rows + REGION_PADDING),
+            )
+            regions.append((box, float(sum(scores[r, c] for r, c in cells))))
+
+        regions = sorted(_merge(regions), key=lambda region: -region[1])[:max_regions]
+        current.set(cells=rows * cols, threshold=round(threshold, 2), regions=len(regions))
+        return [{"box": box, "score": score} for box, score in regions]
+
+
+def crop(image: Image.Image, box) -> Image.Image:
+    x0, y0, x1, y1 = box
+    return image.crop((
+        int(x0 * image.width), int(y0 * image.height),
+        max(int(x0 * image.width) + 1, round(x1 * image.width)),
+        max(int(y0 * image.height) + 1, round(y1 * image.height)),
+    ))
+
+
+def to_image_box(region_box, crop_vertices) -> tuple:
+    """Maps Vision normalizedVertices inside a crop back to normalized coordinates of the full image."""
+    x0, y0, x1, y1 = region_box
+    xs = [x0 + v.get("x", 0) * (x1 - x0) for v in crop_vertices]
+    ys = [y0 + v.get("y", 0) * (y1 - y0) for v in crop_vertices]
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+def box_iou(a, b) -> float:
+    ix = max(0.0, min(a[2], b[2]) - max(a[0], b[0]))
+    iy = max(0.0, min(a[3], b[3]) - max(a[1], b[1]))
+    inter = ix * iy
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
@@ -0,0 +1,140 @@
+import json
+import os
+import time
+from dotenv import load_dotenv
+from modules import governor, http_client, tracing
+
+load_dotenv()
+
+GROQ_API_KEY = os.getenv("GROQ_API_KEY")
+GROQ_URL = os.getenv("GROQ_API_URL", "https://api.groq.com/openai/v1/chat/completions")
+GROQ_MODEL = "meta-llama/llama-4-scout-17b-16e-instruct"
+SYSTEM_PROMPT = "You are a helpful interior-design assistant."
+
+
+def _build_payload(user_message, history, stream=False, notes=()):
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT}
+    ]
+    for note in notes:
+        messages.append({"role": "system", "content": note})
+    for entry in history:
+        messages.append({"role": entry["role"], "content": entry["content"]})
+    messages.append({"role": "user", "content": user_message})
+
+    payload = {
+        "model": GROQ_MODEL,
+        "messages": messages,
+        "temperature": 0.7,
+        "max_tokens": 512,
+    }
+    if stream:
+        payload["stream"] = True
+    return payload
+
+
+def _headers():
+    return {
+        "Authorization": f"Bearer {GROQ_API_KEY}",
+        "Content-Type": "application/json",
+    }
+
+
+@tracing.traced("chat.completion")
+def chat_with_groq(user_message, history, notes=()):
+    """
+    Sends the conversation (history + new user message) to Groq’s
+    chat completions endpoint using the Llama 4 Scout model, returning the reply.
+    `notes` are extra system messages such as a summary of older turns.
+    """
+    resp = http_client.request(
+        "groq", "POST", GROQ_URL,
+        json=_build_payload(user_message, history, notes=notes),
+        headers=_headers(),
+    )
+    resp.raise_for_status()
+    data = resp.json()
+    return data["choices"][0]["message"]["content"].strip()
+
+
+@tracing.traced("chat.summarize")
+def summarize_conversation(previous_summary, messages):
+    """Folds `messages` into `previous_summary` for the chat context window."""
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+    if previous_summary:
+        transcript = f"Summary so far: {previous_summary}\n{transcript}"
+    payload = {
+        "model": GROQ_MODEL,
+        "messages": [
+            {"role": "system", "content": (
+                "Summarize this interior-design conversation in under 120 words. "
+                "Keep the user's room details, stated preferences, budget and decisions."
+            )},
+            {"role": "user", "content": transcript},
+        ],
+        "temperature": 0.2,
+        "max_tokens": 200,
+    }
+    # Housekeeping for the context window: yields to replies the user is waiting on.
+    resp = http_client.request("groq", "POST", GROQ_URL, json=payload, headers=_headers(),
+                               priority=governor.FOREGROUND)
+    resp.raise_for_status()
+    return resp.json()["choices"][0]["message"]["content"].strip()
+
+
+def stream_chat_with_groq(user_message, history, metrics=None, notes=()):
+    """
+    Streaming variant of chat_with_groq: yields content deltas from the
+    OpenAI-compatible SSE response as they arrive. If `metrics` is a dict it
+    is filled with "ttft" (seconds to first token) and "total" latency.
+    Closing the generator early closes the upstream connection.
+    """
+    metrics = metrics if metrics is not None else {}
+    started = time.perf_counter()
+    # The span outlives each yield, so it is only made current around the request itself.
+    current = tracing.Span("chat.stream", tracing.current_span())
+    try:
+        with tracing.use(current):
+            resp = http_client.request(
+                "groq", "POST", GROQ_URL,
+                json=_build_payload(user_message, history, stream=True, notes=notes),
+                headers=_headers(),
+                stream=True,
+            )
+    except Exception as e:
+        tracing.finish(current, e)
+        raise
+    error = None
+    try:
+        if resp.status_code >= 400:
+            resp.content  # read the error body so raise_for_status can report it
+            resp.raise_for_status()
+        # SSE is UTF-8, but requests would guess latin-1 for text/event-stream.
+        for raw in resp.iter_lines(chunk_size=None):
+            current.add("bytes_in", len(raw) + 1)
+            line = raw.decode("utf-8")
+            if not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                break
+            chunk = json.loads(data)
+            if "error" in chunk:
+                raise RuntimeError(chunk["error"].get("message", str(chunk["error"])))
+            choices = chunk.get("choices") or [{}]
+            delta = choices[0].get("delta", {}).get("content")
+            if delta:
+                if "ttft" not in metrics:
+                    metrics["ttft"] = time.perf_counter() - started
+                    current.set(ttft_ms=round(metrics["ttft"] * 1000, 2))
+                yield delta
+    except GeneratorExit:
+        current.set(stopped=True)
+        raise
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        metrics["total"] = time.perf_counter() - started
+        resp.close()
+        tracing.finish(current, error)
@@ -0,0 +1,108 @@
+import hashlib
+import logging
+import math
+import os
+
+logger = logging.getLogger(__name__)
+
+CHAT_CONTEXT_TOKENS = int(os.getenv("CHAT_CONTEXT_TOKENS", "2000"))
+# After folding, keep the verbatim tail under this share of the budget so the
+# summary is not recomputed on every new message.
+RETAIN_FRACTION = 0.6
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough Llama-style estimate: about four characters per token."""
+    return math.ceil(len(text) / 4)
+
+
+def estimate_message_tokens(message: dict) -> int:
+    return estimate_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+
+
+def room_context(analysis: dict) -> str:
+    """Compact one-line description of a Vision analysis for the system prompt."""
+    objects = []
+    for obj in sorted(analysis.get("objects", []), key=lambda x: -x["score"]):
+        if obj["name"] not in objects:
+            objects.append(obj["name"])
+    labels = [label["description"] for label in analysis.get("labels", [])[:6]]
+    colors = [
+        f"#{int(c['r']):02x}{int(c['g']):02x}{int(c['b']):02x}"
+        for c in sorted(analysis.get("colors", []), key=lambda c: -c["fraction"])[:3]
+    ]
+
+    parts = []
+    if objects:
+        parts.append("objects: " + ", ".join(objects[:8]))
+    if labels:
+        parts.append("labels: " + ", ".join(labels))
+    if colors:
+        parts.append("dominant colors: " + ", ".join(colors))
+    return "The user's room — " + "; ".join(parts) + "." if parts else ""
+
+
+def _fingerprint(messages: list) -> str:
+    h = hashlib.sha256()
+    for message in messages:
+        h.update(f"{message['role']}\0{message['content']}\0".encode())
+    return h.hexdigest()
+
+
+class ChatContext:
+    """
+    Keeps the chat payload within a token budget. The most recent turns are
+    sent verbatim; older turns are folded into a rolling summary produced by
+    `summarize(previous_summary, messages)`. The summary is cached and only
+    recomputed when more turns need folding or the folded history changes.
+    """
+
+    def __init__(self, summarize, budget_tokens=CHAT_CONTEXT_TOKENS):
+        self.summarize = summarize
+        self.budget_tokens = budget_tokens
+        self.summary = ""
+        self.folded = 0  # number of leading history messages covered by the summary
+        self._folded_fingerprint = _fingerprint([])
+
+    def _fold(self, history: list, cut: int):
+        try:
+            self.summary = self.summarize(self.summary, history[self.folded:cut])
+        except Exception as e:
+            # Without a summary the old turns are simply dropped.
+            logger.warning("Chat summary failed: %s", e)
+        self.folded = cut
+        self._folded_fingerprint = _fingerprint(history[:cut])
+
+    def build(self, history: list, user_message: str, room_note: str = "") -> tuple:
+        """
+        Returns (notes, recent) for `user_message`: extra system notes (the
+        running summary and room context) and the verbatim history tail.
+        """
+        if self.folded > len(history) or _fingerprint(history[:self.folded]) != self._folded_fingerprint:
+            self.summary, self.folded = "", 0
+            self._folded_fingerprint = _fingerprint([])
+
+        budget = self.budget_tokens - estimate_tokens(user_message) - estimate_tokens(room_note)
+        if self.summary:
+            budget -= estimate_tokens(self.summary) + MESSAGE_OVERHEAD_TOKENS
+
+        recent = history[self.folded:]
+        if sum(estimate_message_tokens(m) for m in recent) > budget:
+            target = budget * RETAIN_FRACTION
+            cut, used = len(history), 0
+            while cut > self.folded and used + estimate_message_tokens(history[cut - 1]) <= target:
+                cut -= 1
+                used += estimate_message_tokens(history[cut])
+            # Nothing new to fold when even the newest message is over budget
+            # (e.g. a huge user message); keep the existing summary as is.
+            if cut > self.folded:
+                self._fold(history, cut)
+                recent = history[cut:]
+
+        notes = []
+        if self.summary:
+            notes.append(f"Summary of the earlier conversation: {self.summary}")
+        if room_note:
+            notes.append(room_note)
+        return notes, recent
@@ -0,0 +1,62 @@
+import contextvars
+import os
+import time
+from contextlib import contextmanager
+
+# Overall budget for one Generate Redesign click: queueing, analysis, the
+# SDXL render, item detection and the product lookups shown with the result.
+REDESIGN_DEADLINE = float(os.getenv("REDESIGN_DEADLINE", "120"))
+# Budget for one Generate Variants click: every variant's queueing and render.
+VARIANTS_DEADLINE = float(os.getenv("VARIANTS_DEADLINE", "300"))
+
+# Absolute time.monotonic() value the current request must finish by, or None.
+_expires_at = contextvars.ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+def expires_in(seconds: float) -> float:
+    """Deadline `seconds` from now, for scope() or to keep across reruns."""
+    return time.monotonic() + seconds
+
+
+@contextmanager
+def scope(expires_at):
+    """
+    Bounds everything run in this context, including workers started from
+    it via tracing.run_in_context, by `expires_at` (see expires_in). A
+    nested scope can only shorten the current deadline; None keeps it.
+    """
+    current = _expires_at.get()
+    if expires_at is None or (current is not None and current <= expires_at):
+        yield
+        return
+    token = _expires_at.set(expires_at)
+    try:
+        yield
+    finally:
+        _expires_at.reset(token)
+
+
+def remaining():
+    """Seconds left before the current deadline (may be negative), or None without one."""
+    expires_at = _expires_at.get()
+    return None if expires_at is None else expires_at - time.monotonic()
+
+
+def check(stage: str, needed=0.0):
+    """Raises DeadlineExceeded unless at least `needed` seconds are left for `stage`."""
+    left = remaining()
+    if left is not None and left < max(needed, 0.001):
+        raise DeadlineExceeded(f"Not enough time left for {stage} ({max(left, 0):.1f}s of the deadline remaining).")
+
+
+def clamp(timeout, stage="this request"):
+    """`timeout` shrunk to the time left (None means no limit); raises DeadlineExceeded once it has passed."""
+    left = remaining()
+    if left is None:
+        return timeout
+    check(stage)
+    return left if timeout is None else min(timeout, left)
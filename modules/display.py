@@ -0,0 +1,57 @@
+import base64
+import io
+import os
+import threading
+from collections import OrderedDict
+from PIL import Image, features
+from modules import tracing
+from modules.cache import image_digest
+
+PREVIEW_MAX_EDGE = int(os.getenv("PREVIEW_MAX_EDGE", "1280"))
+PREVIEW_QUALITY = int(os.getenv("PREVIEW_QUALITY", "82"))
+PREVIEW_FORMAT = os.getenv("PREVIEW_FORMAT", "WEBP" if features.check("webp") else "JPEG").upper()
+DISPLAY_CACHE_BYTES = int(os.getenv("DISPLAY_CACHE_MB", "64")) * 1024 * 1024
+
+MIME_TYPES = {"WEBP": "image/webp", "JPEG": "image/jpeg", "PNG": "image/png"}
+
+_encoded = OrderedDict()
+_encoded_bytes = 0
+_lock = threading.Lock()
+
+
+def _cached(key, encode, fmt):
+    global _encoded_bytes
+    with _lock:
+        if key in _encoded:
+            _encoded.move_to_end(key)
+            return _encoded[key]
+    with tracing.span("image.encode", format=fmt) as current:
+        data = encode()
+        current.set(bytes_out=len(data))
+    with _lock:
+        if key not in _encoded:
+            _encoded[key] = data
+            _encoded_bytes += len(data)
+        while _encoded_bytes > DISPLAY_CACHE_BYTES and len(_encoded) > 1:
+            _, evicted = _encoded.popitem(last=False)
+            _encoded_bytes -= len(evicted)
+    return data
+
+
+def preview_bytes(image: Image.Image, max_edge=PREVIEW_MAX_EDGE, fmt=PREVIEW_FORMAT) -> bytes:
+    """Right-sized lossy preview for on-page display, encoded once per image."""
+    def encode():
+        preview = image if image.mode in ("RGB", "L") else image.convert("RGB")
+        if max(preview.size) > max_edge:
+            preview = preview.copy()
+            preview.thumbnail((max_edge, max_edge), Image.BILINEAR, reducing_gap=2.0)
+        buff = io.BytesIO()
+        preview.save(buff, format=fmt, quality=PREVIEW_QUALITY)
+        return buff.getvalue()
+
+    return _cached((image_digest(image), "preview", max_edge, fmt), encode, fmt)
+
+
+def preview_data_uri(image: Image.Image, max_edge=PREVIEW_MAX_EDGE, fmt=PREVIEW_FORMAT) -> str:
+    data = base64.b64encode(preview_bytes(image, max_edge, fmt)).decode()
+    return f"data:{MIME_TYPES[fmt]};base64,{data}"
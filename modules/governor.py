@@ -0,0 +1,227 @@
+import contextvars
+import datetime
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+# Lower value wins: chat the user is waiting on beats analysis and renders,
+# which beat product lookups and other work nobody is watching yet.
+INTERACTIVE, FOREGROUND, BACKGROUND = 0, 1, 2
+PRIORITY_NAMES = {INTERACTIVE: "interactive", FOREGROUND: "foreground", BACKGROUND: "background"}
+
+
+def _limit(name, rate, burst, max_wait):
+    prefix = f"GOVERNOR_{name.upper()}"
+    return {
+        "rate": float(os.getenv(f"{prefix}_RPS", rate)),          # tokens per second
+        "burst": float(os.getenv(f"{prefix}_BURST", burst)),      # bucket size
+        "daily_quota": int(os.getenv(f"{prefix}_DAILY", "0")),   # requests per UTC day, 0 = unlimited
+        "max_wait": float(os.getenv(f"{prefix}_MAX_WAIT", max_wait)),  # longest queue wait before Busy
+    }
+
+
+# Defaults sit under the public free-tier limits of each API.
+LIMITS = {
+    "vision": _limit("vision", 10, 10, 60),
+    "hf": _limit("hf", 1, 2, 120),
+    "serpapi": _limit("serpapi", 2, 4, 30),
+    "groq": _limit("groq", 0.5, 5, 30),
+}
+
+UPSTREAM_NAMES = {"vision": "Google Vision", "hf": "the image generator", "serpapi": "product search", "groq": "the chat assistant"}
+
+_session = contextvars.ContextVar("governor_session", default="default")
+
+
+class Busy(RuntimeError):
+    """The upstream is saturated: raised instead of queueing past max_wait, with the caller's queue position."""
+
+    def __init__(self, upstream, position, waited):
+        self.upstream, self.position, self.waited = upstream, position, waited
+        super().__init__(
+            f"{UPSTREAM_NAMES.get(upstream, upstream)} is busy right now "
+            f"(position {position} in queue after {waited:.0f}s); please try again shortly."
+        )
+
+
+class QuotaExceeded(RuntimeError):
+    def __init__(self, upstream, quota):
+        self.upstream, self.quota = upstream, quota
+        super().__init__(f"Daily quota of {quota} requests to {UPSTREAM_NAMES.get(upstream, upstream)} is used up.")
+
+
+def set_session(session_id: str):
+    """Tags upstream calls made from the current context (and workers started from it) with `session_id`."""
+    _session.set(session_id)
+
+
+class _Waiter:
+    __slots__ = ("session", "priority", "granted")
+
+    def __init__(self, session_id, priority):
+        self.session = session_id
+        self.priority = priority
+        self.granted = False
+
+
+class Limiter:
+    """
+    Token bucket for one upstream with a fair queue in front: waiters are
+    served by priority, and round-robin across sessions within a priority,
+    so one session's burst cannot starve the others.
+    """
+
+    def __init__(self, name, rate, burst, daily_quota=0, max_wait=60.0):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.daily_quota = daily_quota
+        self.max_wait = max_wait
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._queues = {p: OrderedDict() for p in PRIORITY_NAMES}  # priority -> session -> deque of waiters
+        self._cond = threading.Condition()
+        self._day = None
+        self._used_today = 0
+        self._counters = {"granted": 0, "busy": 0, "quota_rejected": 0, "throttled": 0, "wait_seconds": 0.0}
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _order(self) -> list:
+        """Waiters in the order they would be served."""
+        order = []
+        for priority in sorted(self._queues):
+            queues = [list(q) for q in self._queues[priority].values()]
+            for i in range(max(map(len, queues), default=0)):
+                order.extend(q[i] for q in queues if i < len(q))
+        return order
+
+    def _dispatch(self, now):
+        self._refill(now)
+        if now < self._paused_until:
+            return
+        for priority in sorted(self._queues):
+            sessions = self._queues[priority]
+            while sessions and self._tokens >= 1:
+                session_id, waiters = next(iter(sessions.items()))
+                waiters.popleft().granted = True
+                self._tokens -= 1
+                # Rotate: this session goes to the back of its priority level.
+                del sessions[session_id]
+                if waiters:
+                    sessions[session_id] = waiters
+            if self._tokens < 1:
+                return
+
+    def _remove(self, waiter):
+        sessions = self._queues[waiter.priority]
+        waiters = sessions.get(waiter.session)
+        if waiters is not None and waiter in waiters:
+            waiters.remove(waiter)
+            if not waiters:
+                del sessions[waiter.session]
+
+    def _check_quota(self):
+        today = datetime.datetime.now(datetime.timezone.utc).date()
+        if today != self._day:
+            self._day, self._used_today = today, 0
+        if self.daily_quota and self._used_today >= self.daily_quota:
+            self._counters["quota_rejected"] += 1
+            raise QuotaExceeded(self.name, self.daily_quota)
+
+    def acquire(self, priority=FOREGROUND, session_id=None, max_wait=None) -> float:
+        """Blocks until a token is granted; returns the seconds spent queued. Raises Busy or QuotaExceeded."""
+        session_id = session_id or _session.get()
+        max_wait = self.max_wait if max_wait is None else max_wait
+        started = time.monotonic()
+        with self._cond:
+            self._check_quota()
+            waiter = _Waiter(session_id, priority)
+            self._queues[priority].setdefault(session_id, deque()).append(waiter)
+            while True:
+                now = time.monotonic()
+                self._dispatch(now)
+                if waiter.granted:
+                    break
+                waited = now - started
+                if waited >= max_wait:
+                    position = self._order().index(waiter) + 1
+                    self._remove(waiter)
+                    self._counters["busy"] += 1
+                    raise Busy(self.name, position, waited)
+                # Sleep until the next token is due (or a pause ends); grants wake everyone.
+                next_token = max((1 - self._tokens) / self.rate if self.rate > 0 else max_wait, self._paused_until - now)
+                self._cond.wait(min(max(next_token, 0.005), max_wait - waited))
+            self._cond.notify_all()
+            self._used_today += 1
+            waited = time.monotonic() - started
+            self._counters["granted"] += 1
+            self._counters["wait_seconds"] += waited
+            return waited
+
+    def try_acquire(self) -> bool:
+        """
+        Takes a token only if one is spare right now: nobody is queued, the
+        bucket is not paused and the daily quota has room. Never waits, so
+        optional extra calls (e.g. hedges) only use idle capacity.
+        """
+        with self._cond:
+            now = time.monotonic()
+            self._refill(now)
+            if (now < self._paused_until or self._tokens < 1
+                    or any(self._queues[p] for p in self._queues)):
+                return False
+            try:
+                self._check_quota()
+            except QuotaExceeded:
+                return False
+            self._tokens -= 1
+            self._used_today += 1
+            self._counters["granted"] += 1
+            return True
+
+    def throttle(self, seconds: float):
+        """Pauses the bucket for every session, e.g. after the upstream answered 429."""
+        with self._cond:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0
+            self._counters["throttled"] += 1
+
+    def position(self, session_id) -> int:
+        """1-based queue position of the session's oldest waiter, or 0 if it is not queued."""
+        with self._cond:
+            for i, waiter in enumerate(self._order()):
+                if waiter.session == session_id:
+                    return i + 1
+        return 0
+
+    def stats(self) -> dict:
+        with self._cond:
+            stats = dict(self._counters)
+            stats.update({
+                "queued": sum(len(w) for q in self._queues.values() for w in q.values()),
+                "used_today": self._used_today,
+                "daily_quota": self.daily_quota,
+            })
+        return stats
+
+
+limiters = {name: Limiter(name, **limit) for name, limit in LIMITS.items()}
+
+
+def queue_status(session_id) -> dict:
+    """{upstream: position} for every upstream where `session_id` is currently waiting."""
+    status = {}
+    for name, limiter in limiters.items():
+        position = limiter.position(session_id)
+        if position:
+            status[name] = position
+    return status
+
+
+def stats() -> dict:
+    return {name: limiter.stats() for name, limiter in limiters.items()}
@@ -0,0 +1,236 @@
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from modules import deadline, governor, tracing
+
+POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "16"))
+
+# Idempotent endpoints marked "hedge" get a second, identical request when
+# the first has not answered within this percentile of recent latencies;
+# whichever answers first is used. 0 disables hedging.
+HEDGE_PERCENTILE = float(os.getenv("HTTP_HEDGE_PERCENTILE", "95"))
+HEDGE_MIN_SAMPLES = 20   # latencies to observe before hedging at all
+HEDGE_WINDOW = 200       # recent latencies kept per endpoint
+HEDGE_MIN_DELAY = 0.05
+
+# Per-endpoint policy: (connect, read) timeouts in seconds, how many times to
+# retry a 429/5xx or connection failure, the largest body we will read and
+# the default governor priority of its calls.
+ENDPOINTS = {
+    "vision": {
+        "connect_timeout": 5, "read_timeout": 30, "retries": 2,
+        "max_bytes": 8 * 1024 * 1024, "priority": governor.FOREGROUND, "hedge": True,
+    },
+    "hf": {
+        "connect_timeout": 5, "read_timeout": 60, "retries": 1,
+        "max_bytes": 32 * 1024 * 1024, "priority": governor.FOREGROUND,
+        # 503 means "model is loading"; the caller waits out estimated_time instead.
+        "retry_statuses": {429, 500, 502, 504},
+    },
+    "serpapi": {
+        "connect_timeout": 5, "read_timeout": 10, "retries": 2,
+        "max_bytes": 4 * 1024 * 1024, "priority": governor.BACKGROUND, "hedge": True,
+    },
+    "groq": {
+        "connect_timeout": 5, "read_timeout": 30, "retries": 2,
+        "max_bytes": 1024 * 1024, "priority": governor.INTERACTIVE,
+    },
+}
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 8.0
+CHUNK_SIZE = 64 * 1024
+
+
+class ResponseTooLarge(requests.RequestException):
+    pass
+
+
+# Sends the attempts of hedged requests; both run here so the caller can wait on the first.
+_hedge_executor = ThreadPoolExecutor(max_workers=POOL_SIZE * 2, thread_name_prefix="http-hedge")
+_latencies = {name: deque(maxlen=HEDGE_WINDOW) for name, policy in ENDPOINTS.items() if policy.get("hedge")}
+_latencies_lock = threading.Lock()
+
+# One keep-alive pool per host, shared by every Streamlit session in the process.
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def _session_for(url: str) -> requests.Session:
+    parts = urlsplit(url)
+    host = f"{parts.scheme}://{parts.netloc}"
+    with _sessions_lock:
+        session = _sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+            session.mount(host, adapter)
+            _sessions[host] = session
+        return session
+
+
+def _backoff_delay(attempt: int, response=None) -> float:
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after and retry_after.isdigit():
+        return min(float(retry_after), BACKOFF_CAP)
+    # Full jitter keeps concurrent sessions from retrying in lockstep.
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+def _hedge_delay(endpoint: str):
+    """Seconds to wait before hedging a call to `endpoint`, or None if it is not hedged (yet)."""
+    if HEDGE_PERCENTILE <= 0 or endpoint not in _latencies:
+        return None
+    with _latencies_lock:
+        samples = sorted(_latencies[endpoint])
+    if len(samples) < HEDGE_MIN_SAMPLES:
+        return None
+    index = min(len(samples) - 1, int(len(samples) * HEDGE_PERCENTILE / 100))
+    return max(samples[index], HEDGE_MIN_DELAY)
+
+
+def _timed_send(session, method, url, **kwargs):
+    started = time.monotonic()
+    response = session.request(method, url, **kwargs)
+    return response, time.monotonic() - started
+
+
+def _close_when_done(future):
+    """Releases the connection of an attempt that lost the race, once it finishes."""
+    def close(done):
+        if not done.cancelled() and done.exception() is None:
+            done.result()[0].close()
+    future.add_done_callback(close)
+
+
+def _send(endpoint, limiter, session, method, url, **kwargs) -> requests.Response:
+    """
+    One attempt, hedged for endpoints that allow it: if no response has
+    arrived after _hedge_delay, a duplicate is sent (only if the governor
+    has a spare token) and the first one to answer wins.
+    """
+    delay = _hedge_delay(endpoint)
+    if delay is None:
+        response, elapsed = _timed_send(session, method, url, **kwargs)
+        if endpoint in _latencies:
+            with _latencies_lock:
+                _latencies[endpoint].append(elapsed)
+        return response
+
+    attempts = [_hedge_executor.submit(_timed_send, session, method, url, **kwargs)]
+    done, _ = wait(attempts, timeout=delay)
+    if not done and limiter.try_acquire():
+        tracing.count("hedged")
+        attempts.append(_hedge_executor.submit(_timed_send, session, method, url, **kwargs))
+
+    pending, error = set(attempts), None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is not None:
+                error = error or future.exception()
+                continue
+            response, elapsed = future.result()
+            with _latencies_lock:
+                _latencies[endpoint].append(elapsed)
+            if future is not attempts[0]:
+                tracing.count("hedge_wins")
+            for other in attempts:
+                if other is not future:
+                    _close_when_done(other)
+            return response
+    raise error
+
+
+def _read_limited(response: requests.Response, max_bytes: int):
+    length = response.headers.get("Content-Length")
+    if length and length.isdigit() and int(length) > max_bytes:
+        response.close()
+        raise ResponseTooLarge(f"Response of {length} bytes exceeds the {max_bytes} byte limit", response=response)
+
+    chunks, total = [], 0
+    for chunk in response.iter_content(CHUNK_SIZE):
+        total += len(chunk)
+        if total > max_bytes:
+            response.close()
+            raise ResponseTooLarge(f"Response exceeds the {max_bytes} byte limit", response=response)
+        chunks.append(chunk)
+        left = deadline.remaining()
+        if left is not None and left <= 0:
+            response.close()
+            raise deadline.DeadlineExceeded(f"Deadline passed while reading the response from {response.url}")
+    response._content = b"".join(chunks)
+
+
+def _time_for(delay: float) -> bool:
+    """Whether a retry after sleeping `delay` seconds would still leave time before the deadline."""
+    left = deadline.remaining()
+    return left is None or left > delay
+
+
+def request(endpoint: str, method: str, url: str, timeout=None, stream=False, priority=None,
+            **kwargs) -> requests.Response:
+    """
+    Sends a request through the pooled session for `url`'s host using the
+    policy of `endpoint` (a key of ENDPOINTS). `timeout` overrides the read
+    timeout. With stream=True the body is left unread for the caller, who
+    must close the response; otherwise it is read up to the size limit.
+    Every attempt first takes a token from the endpoint's governor limiter
+    at `priority` (the endpoint default if None), which may raise
+    governor.Busy or governor.QuotaExceeded. Inside a deadline.scope the
+    queue wait, timeouts and retries shrink to the time left, and
+    deadline.DeadlineExceeded is raised once it is gone. Status codes are
+    not raised; callers decide what an error means.
+    """
+    policy = ENDPOINTS[endpoint]
+    read_timeout = timeout if timeout is not None else policy["read_timeout"]
+    session = _session_for(url)
+    limiter = governor.limiters[endpoint]
+    priority = policy["priority"] if priority is None else priority
+
+    attempt = 0
+    while True:
+        queued = limiter.acquire(priority, max_wait=deadline.clamp(limiter.max_wait, endpoint))
+        if queued >= 0.001:
+            tracing.count("queued_ms", round(queued * 1000, 1))
+        timeouts = (deadline.clamp(policy["connect_timeout"], endpoint), deadline.clamp(read_timeout, endpoint))
+        try:
+            response = _send(endpoint, limiter, session, method, url, timeout=timeouts, stream=True, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            delay = _backoff_delay(attempt)
+            if attempt >= policy["retries"] or not _time_for(delay):
+                tracing.annotate(upstream_status=type(e).__name__)
+                if isinstance(e, requests.Timeout) and not _time_for(0):
+                    # The timeout was the deadline's, not the endpoint's.
+                    raise deadline.DeadlineExceeded(f"Deadline passed waiting for {endpoint}: {e}") from e
+                raise
+            time.sleep(delay)
+            attempt += 1
+            tracing.count("retries")
+            continue
+
+        retry_statuses = policy.get("retry_statuses", RETRY_STATUSES)
+        if response.status_code == 429:
+            # Slow every session down, not just this one, until the upstream recovers.
+            limiter.throttle(_backoff_delay(attempt, response))
+        delay = _backoff_delay(attempt, response)
+        if response.status_code in retry_statuses and attempt < policy["retries"] and _time_for(delay):
+            response.close()
+            time.sleep(delay)
+            attempt += 1
+            tracing.count("retries")
+            continue
+
+        tracing.annotate(upstream_status=response.status_code)
+        tracing.count("bytes_out", len(response.request.body or b""))
+        if not stream:
+            _read_limited(response, policy["max_bytes"])
+            tracing.count("bytes_in", len(response.content))
+        return response
@@ -1,46 +1,196 @@
+import logging
 import random
+import time
 from PIL import Image
-import requests
 import io
-import base64
 import os
 from dotenv import load_dotenv
+from modules.cache import SingleFlight, TieredCache, image_digest, make_key
+from modules.vision_payload import encode_for_vision
+from modules import deadline, http_client, tracing
+from modules.jobs import JobCancelled
+from modules.resolution import fit_output, generation_size, record_generation
+
+logger = logging.getLogger(__name__)
 
 load_dotenv()
 
 HF_TOKEN = os.getenv("HF_TOKEN")
 GOOGLE_API_KEY = os.getenv("GOOGLE_VISION_API_KEY")
+VISION_API_URL = os.getenv("VISION_API_URL", "https://vision.googleapis.com/v1/images:annotate")
+HF_MAX_LOADING_WAIT = float(os.getenv("HF_MAX_LOADING_WAIT", "300"))
 
 API_CONFIG = {
     "sd": {
-        "url": "https://api-inference.huggingface.co/models/stabilityai/stable-diffusion-xl-base-1.0",
+        "url": os.getenv("SDXL_API_URL", "https://api-inference.huggingface.co/models/stabilityai/stable-diffusion-xl-base-1.0"),
         "headers": {"Authorization": f"Bearer {HF_TOKEN}"}
     }
 }
 
+# Vision results are cached per (pixel hash, feature) so a request for a subset
+# of features, e.g. labels only, is served from an earlier full analysis.
+vision_cache = TieredCache(
+    "vision",
+    max_entries=int(os.getenv("VISION_CACHE_ENTRIES", "512")),
+    max_disk_bytes=int(os.getenv("VISION_CACHE_DISK_MB", "64")) * 1024 * 1024,
+)
+
+# Rendered SDXL outputs (PNG bytes) keyed by input pixels, style, seed and
+# parameters; the disk tier is shared by every session and process.
+generation_cache = TieredCache(
+    "generations",
+    max_entries=int(os.getenv("GENERATION_CACHE_ENTRIES", "16")),
+    max_disk_bytes=int(os.getenv("GENERATION_CACHE_DISK_MB", "512")) * 1024 * 1024,
+    dumps=bytes,
+    loads=bytes,
+)
+
+MAX_SEED = 99999
+
+
+def normalize_style(style_description: str) -> str:
+    return " ".join(style_description.lower().split()).strip(" .,!")
+
+
+def derive_seed(image: Image.Image, style_description: str) -> int:
+    """Deterministic seed for an (image, style) pair, so repeat requests render identically."""
+    return int(make_key(image_digest(image), normalize_style(style_description))[:8], 16) % (MAX_SEED + 1)
+
+
+# Response fields produced by each Vision feature type.
+FEATURE_FIELDS = {
+    "LABEL_DETECTION": ("labelAnnotations",),
+    "OBJECT_LOCALIZATION": ("localizedObjectAnnotations",),
+    "IMAGE_PROPERTIES": ("imagePropertiesAnnotation",),
+    "TEXT_DETECTION": ("textAnnotations",),
+}
+
+ANALYSIS_FEATURES = [
+    {"type": "LABEL_DETECTION"},
+    {"type": "OBJECT_LOCALIZATION"},
+    {"type": "IMAGE_PROPERTIES"},
+    {"type": "TEXT_DETECTION"},
+]
+
+
+def _feature_key(feature: dict) -> str:
+    # Vision returns at most 10 results when maxResults is not given.
+    return f"{feature['type']}:{feature.get('maxResults', 10)}"
+
+
+def _rescale_text(response: dict, scale: float):
+    """Maps OCR pixel vertices from the downscaled payload back to the original image."""
+    if scale == 1.0:
+        return
+    for text in response.get("textAnnotations", []):
+        for v in text.get("boundingPoly", {}).get("vertices", []):
+            for axis in ("x", "y"):
+                if axis in v:
+                    v[axis] = round(v[axis] / scale)
+
+
+# images:annotate accepts at most 16 images and a 10 MB JSON body per call.
+VISION_MAX_IMAGES_PER_CALL = 16
+VISION_MAX_PAYLOAD_BYTES = 10 * 1024 * 1024 - 64 * 1024  # headroom for the JSON envelope
+
+
+def _pack_batches(entries: list) -> list:
+    """Greedily groups (index, request) pairs into calls within Vision's payload limits."""
+    batches, current, current_bytes = [], [], 0
+    for index, request in entries:
+        size = len(request["image"]["content"]) + 256
+        if current and (len(current) >= VISION_MAX_IMAGES_PER_CALL
+                        or current_bytes + size > VISION_MAX_PAYLOAD_BYTES):
+            batches.append(current)
+            current, current_bytes = [], 0
+        current.append((index, request))
+        current_bytes += size
+    if current:
+        batches.append(current)
+    return batches
+
+
+@tracing.traced("vision.annotate")
+def annotate_images(items: list) -> list:
+    """
+    Batched variant of annotate_image: takes (image, features) pairs and
+    returns one response dict per pair, in order. Cached features are
+    served locally; the rest are packed into as few annotate calls as the
+    payload limits allow and split back out per image.
+    """
+    tracing.annotate(images=len(items))
+    results = [{} for _ in items]
+    pending = []  # (index, digest, missing features, payload scale, request)
+    for index, (image, features) in enumerate(items):
+        digest = image_digest(image)
+        missing = []
+        for feature in features:
+            cached = vision_cache.get(f"{digest}-{_feature_key(feature)}")
+            if cached is None:
+                missing.append(feature)
+            else:
+                tracing.count("cache_hits")
+                results[index].update(cached)
+        if missing:
+            content, scale = encode_for_vision(image, missing, digest)
+            request = {"image": {"content": content}, "features": missing}
+            pending.append((index, digest, missing, scale, request))
+
+    url = f"{VISION_API_URL}?key={GOOGLE_API_KEY}"
+    by_index = {index: (digest, missing, scale) for index, digest, missing, scale, _ in pending}
+    for batch in _pack_batches([(index, request) for index, _, _, _, request in pending]):
+        started = time.perf_counter()
+        with tracing.span("vision.request", images=len(batch)):
+            response = http_client.request("vision", "POST", url, json={"requests": [request for _, request in batch]})
+        try:
+            data = response.json()
+        except ValueError:
+            data = {"error": {"message": f"HTTP {response.status_code} from Vision: {response.text[:200]}"}}
+        elapsed = time.perf_counter() - started
+
+        responses = data.get("responses") or []
+        if len(responses) != len(batch):
+            error = data.get("error", {"message": f"Missing 'responses' in Vision reply: {data}"})
+            for index, _ in batch:
+                results[index] = {"error": error}
+            continue
+
+        cost = elapsed / sum(len(by_index[index][1]) for index, _ in batch)
+        for (index, _), response in zip(batch, responses):
+            if "error" in response:
+                results[index] = {"error": response["error"]}
+                continue
+            digest, missing, scale = by_index[index]
+            _rescale_text(response, scale)
+            for feature in missing:
+                part = {field: response[field] for field in FEATURE_FIELDS.get(feature["type"], ()) if field in response}
+                vision_cache.put(f"{digest}-{_feature_key(feature)}", part, cost=cost)
+                results[index].update(part)
+    return results
+
+
+def annotate_image(image: Image.Image, features: list) -> dict:
+    """
+    Returns the Vision `images:annotate` response for one image, going
+    upstream only for the features that are not cached yet. On error the
+    returned dict carries an "error" entry and nothing is cached.
+    """
+    return annotate_images([(image, features)])[0]
+
+
+# Upload prefetch, generation and the result page may ask for the same
+# analysis at once; only one of them goes to Vision.
+_analysis_flight = SingleFlight()
+
+
 def image_to_text_google_vision(image: Image.Image) -> dict:
-    buffered = io.BytesIO()
-    image.save(buffered, format="JPEG")
-    image_base64 = base64.b64encode(buffered.getvalue()).decode()
+    return _analysis_flight.do(image_digest(image), _analyze, image)
 
-    url = f"https://vision.googleapis.com/v1/images:annotate?key={GOOGLE_API_KEY}"
-    body = {
-        "requests": [
-            {
-                "image": {"content": image_base64},
-                "features": [
-                    {"type": "LABEL_DETECTION"},
-                    {"type": "OBJECT_LOCALIZATION"},
-                    {"type": "IMAGE_PROPERTIES"},
-                    {"type": "TEXT_DETECTION"},
-                ]
-            }
-        ]
-    }
 
-    response = requests.post(url, json=body)
-    response.raise_for_status()
-    data = response.json()["responses"][0]
+def _analyze(image: Image.Image) -> dict:
+    data = annotate_image(image, ANALYSIS_FEATURES)
+    if "error" in data:
+        raise RuntimeError(f"Google Vision API error: {data['error'].get('message', data['error'])}")
 
     def extract_box(vertices):
         return [(v.get("x", 0), v.get("y", 0)) for v in vertices]
@@ -76,6 +226,7 @@ def image_to_text_google_vision(image: Image.Image) -> dict:
         ] if data.get("textAnnotations") else []
     }
 
+@tracing.traced("prompt.build")
 def generate_powerful_prompt(image_analysis: dict, user_prompt: str) -> str:
     objects_desc = []
     for obj in sorted(image_analysis["objects"], key=lambda x: -x["score"])[:3]:
@@ -121,41 +272,162 @@ def generate_powerful_prompt(image_analysis: dict, user_prompt: str) -> str:
         "Steps: 50, Sampler: DPM++ 2M Karras, CFG scale: 7.5, Size: 1024x1024"
     )
 
-def generate_high_quality_image(image: Image.Image, style_description: str) -> Image.Image:
-    try:
-        width, height = (image.width // 16) * 16, (image.height // 16) * 16
-        if (width, height) != (image.width, image.height):
-            image = image.resize((width, height))
-
-        prompt = generate_powerful_prompt(
-            image_analysis=image_to_text_google_vision(image),
-            user_prompt=style_description
-        )
-
-        payload = {
-            "inputs": prompt,
-            "parameters": {
-                "negative_prompt": prompt.split("\n")[1].replace("Negative prompt: ", ""),
-                "width": width,
-                "height": height,
-                "num_inference_steps": 60,
-                "guidance_scale": 8.0,
-                "seed": random.randint(0,99999),
-            }
-        }
-
-        response = requests.post(
+def _post_generation(payload: dict, cancel_event=None):
+    """
+    POSTs to the SDXL endpoint, waiting out Hugging Face's 503 "model is
+    loading" replies (they carry an `estimated_time`) up to HF_MAX_LOADING_WAIT.
+    """
+    waited = 0.0
+    while True:
+        response = http_client.request(
+            "hf", "POST",
             API_CONFIG["sd"]["url"],
             headers=API_CONFIG["sd"]["headers"],
             json=payload,
-            timeout=60
         )
+        if response.status_code != 503 or waited >= HF_MAX_LOADING_WAIT:
+            return response
+        try:
+            estimated = float(response.json().get("estimated_time", 0))
+        except ValueError:
+            return response
+        if estimated <= 0:
+            return response
+
+        wait = min(estimated, HF_MAX_LOADING_WAIT - waited, 60.0)
+        deadline.check("the SDXL model to load", wait)
+        logger.info("SDXL model is loading, retrying in %.0fs", wait)
+        if cancel_event is not None:
+            if cancel_event.wait(wait):
+                raise JobCancelled()
+        else:
+            time.sleep(wait)
+        waited += wait
+
+
+def _generation_parameters(image: Image.Image, seed) -> dict:
+    width, height = generation_size(image.width, image.height)
+    return {
+        "width": width,
+        "height": height,
+        "num_inference_steps": 60,
+        "guidance_scale": 8.0,
+        "seed": random.randint(0, MAX_SEED) if seed is None else seed,
+    }
+
+
+def _render(image_analysis: dict, style_description: str, parameters: dict, cache_key: str,
+            stage=None, cancel_event=None, input_size=None) -> Image.Image:
+    """
+    Builds the prompt for one style and renders it with SDXL at the
+    parameters' size, storing the result in generation_cache.
+    """
+    if stage is not None:
+        stage("prompting")
+    prompt = generate_powerful_prompt(
+        image_analysis=image_analysis,
+        user_prompt=style_description
+    )
+
+    payload = {
+        "inputs": prompt,
+        "parameters": {
+            "negative_prompt": prompt.split("\n")[1].replace("Negative prompt: ", ""),
+            **parameters,
+        }
+    }
+
+    if stage is not None:
+        stage("generating")
+    started = time.perf_counter()
+    with tracing.span("sdxl.generate", width=parameters["width"], height=parameters["height"]) as current:
+        response = _post_generation(payload, cancel_event)
         response.raise_for_status()
+        elapsed = time.perf_counter() - started
+        if input_size is not None:
+            saved = record_generation(input_size, (parameters["width"], parameters["height"]), elapsed)
+            current.set(estimated_seconds_saved=round(saved, 2))
+    generation_cache.put(cache_key, response.content, cost=elapsed)
 
-        return Image.open(io.BytesIO(response.content))
+    return _decode(response.content)
+
+
+def _decode(data: bytes) -> Image.Image:
+    with tracing.span("image.decode", bytes_in=len(data)):
+        image = Image.open(io.BytesIO(data))
+        image.load()
+        return image
+
+
+def _log_failure(e: Exception):
+    logger.error("Generation failed: %s", e)
+    if hasattr(e, 'response') and e.response is not None:
+        logger.error("API response: %s", e.response.text[:1000])
+
+
+def _stylize(image: Image.Image, style_description: str, seed, use_cache, progress, cancel_event):
+    """(seed, render at the generation size) for generate_high_quality_image and generate_variant."""
+    def stage(name):
+        if cancel_event is not None and cancel_event.is_set():
+            raise JobCancelled()
+        if progress is not None:
+            progress(name)
+
+    parameters = _generation_parameters(image, seed)
+    cache_key = make_key(image_digest(image), normalize_style(style_description), parameters)
+    if use_cache:
+        cached = generation_cache.get(cache_key)
+        if cached is not None:
+            tracing.annotate(cache_hit=True)
+            return parameters["seed"], _decode(cached)
+
+    # Analyze the image as uploaded so the result is shared with other callers via the cache
+    stage("analyzing")
+    image_analysis = image_to_text_google_vision(image)
+
+    return parameters["seed"], _render(image_analysis, style_description, parameters, cache_key, stage,
+                                       cancel_event, image.size)
+
+
+@tracing.traced("generate")
+def generate_high_quality_image(image: Image.Image, style_description: str, seed=None, use_cache=True,
+                                progress=None, cancel_event=None) -> Image.Image:
+    """
+    `seed` defaults to a random one; pass derive_seed(...) for reproducible
+    output. SDXL renders at the resolution policy's size and the result is
+    resized back to the input's size. Results are served from
+    generation_cache unless `use_cache` is False, in which case the cached
+    entry is replaced. `progress(stage)` is
+    called with "analyzing", "prompting" and "generating"; setting
+    `cancel_event` stops the run at the next stage boundary with JobCancelled.
+    """
+    try:
+        _, stylized = _stylize(image, style_description, seed, use_cache, progress, cancel_event)
+        return fit_output(stylized, image.size)
+
+    except JobCancelled:
+        raise
+    except Exception as e:
+        _log_failure(e)
+        raise
+
+
+@tracing.traced("variant")
+def generate_variant(image: Image.Image, style_description: str, seed=None, use_cache=True,
+                     progress=None, cancel_event=None) -> dict:
+    """
+    One look for the Compare Styles grid, meant to run as a job_manager job
+    (one per variant, so they share its bounded worker pool). Like
+    generate_high_quality_image, but the render stays at the generation
+    size since variants are only shown as previews. Returns the seed used
+    and the image.
+    """
+    try:
+        seed, stylized = _stylize(image, style_description, seed, use_cache, progress, cancel_event)
+        return {"seed": seed, "image": stylized}
 
+    except JobCancelled:
+        raise
     except Exception as e:
-        print(f"Generation failed: {str(e)}")
-        if hasattr(e, 'response') and e.response is not None:
-            print(f"API response: {e.response.text}")
-        raise
\ No newline at end of file
+        _log_failure(e)
+        raise
@@ -0,0 +1,249 @@
+import atexit
+import io
+import mmap
+import os
+import shutil
+import threading
+import time
+import uuid
+import weakref
+from collections import OrderedDict
+from PIL import Image
+from modules import tracing
+from modules.cache import CACHE_ROOT
+
+# One budget for encoded bytes and decoded pixels held in memory. Decoded
+# copies are dropped first (cheap to rebuild); then the least recently used
+# encoded images are spilled to disk and read back through mmap.
+IMAGE_STORE_BYTES = int(os.getenv("IMAGE_STORE_MB", "256")) * 1024 * 1024
+DECODED_SHARE = 0.5  # at most this much of the budget holds decoded images
+SPILL_ROOT = os.path.join(CACHE_ROOT, "images")
+# Spill directories of processes that exited without cleaning up are removed after this long.
+STALE_SPILL_SECONDS = 24 * 3600
+PNG_COMPRESS_LEVEL = 1  # lossless, so content hashes and caches keyed on pixels still match
+
+
+class ImageStore:
+    """
+    Process-wide store for the app's images, addressed by opaque handles.
+    Images are kept as compact encoded bytes and decoded on demand; a
+    small LRU of decoded copies serves reruns.
+    """
+
+    def __init__(self, budget_bytes=IMAGE_STORE_BYTES, spill_root=SPILL_ROOT):
+        self.budget_bytes = budget_bytes
+        self.spill_dir = os.path.join(spill_root, str(os.getpid()))
+        self._encoded = OrderedDict()   # handle -> bytes, in memory
+        self._spilled = {}              # handle -> path
+        self._decoded = OrderedDict()   # handle -> Image
+        self._encoded_bytes = 0
+        self._decoded_bytes = 0
+        self._lock = threading.Lock()
+        self._counters = {"puts": 0, "decodes": 0, "decoded_hits": 0, "spills": 0, "spill_reads": 0, "released": 0}
+        _sweep_stale(spill_root)
+
+    def put(self, image: Image.Image) -> str:
+        """Stores a decoded image as lossless PNG; returns its handle."""
+        with tracing.span("image.encode", format="PNG") as current:
+            buff = io.BytesIO()
+            image.save(buff, format="PNG", compress_level=PNG_COMPRESS_LEVEL)
+            current.set(bytes_out=buff.tell())
+        # The caller's copy is already decoded; keep it warm for the next rerun.
+        return self.put_bytes(buff.getvalue(), image)
+
+    def put_bytes(self, data: bytes, image=None) -> str:
+        """
+        Stores an already encoded image (e.g. the uploaded file) as is and
+        returns its handle. Pass `image` if the caller already decoded it.
+        """
+        handle = uuid.uuid4().hex
+        with self._lock:
+            self._encoded[handle] = data
+            self._encoded_bytes += len(data)
+            self._counters["puts"] += 1
+            if image is not None:
+                self._remember_decoded(handle, image)
+            self._enforce_budget()
+        return handle
+
+    def get_bytes(self, handle: str) -> bytes:
+        with self._lock:
+            if handle in self._encoded:
+                self._encoded.move_to_end(handle)
+                return self._encoded[handle]
+            path = self._spilled.get(handle)
+        if path is None:
+            raise KeyError(f"Unknown or released image handle {handle}")
+        with open(path, "rb") as f:
+            return f.read()
+
+    def get(self, handle: str) -> Image.Image:
+        """The decoded image for `handle`; treat it as read-only, it may be shared with other reruns."""
+        with self._lock:
+            if handle in self._decoded:
+                self._decoded.move_to_end(handle)
+                self._counters["decoded_hits"] += 1
+                return self._decoded[handle]
+            data = self._encoded.get(handle)
+            path = self._spilled.get(handle)
+            if data is not None:
+                self._encoded.move_to_end(handle)
+        if data is None and path is None:
+            raise KeyError(f"Unknown or released image handle {handle}")
+
+        with tracing.span("image.decode", bytes_in=len(data) if data is not None else os.path.getsize(path)):
+            if data is not None:
+                image = _decode(io.BytesIO(data))
+            else:
+                # Decode straight from the page cache instead of copying the file into memory first.
+                with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    image = _decode(mapped)
+                with self._lock:
+                    self._counters["spill_reads"] += 1
+
+        with self._lock:
+            self._counters["decodes"] += 1
+            if handle in self._encoded or handle in self._spilled:
+                self._remember_decoded(handle, image)
+                self._enforce_budget()
+        return image
+
+    def release(self, handles):
+        """Forgets `handles`, deleting any spilled files."""
+        paths = []
+        with self._lock:
+            for handle in list(handles):
+                data = self._encoded.pop(handle, None)
+                if data is not None:
+                    self._encoded_bytes -= len(data)
+                image = self._decoded.pop(handle, None)
+                if image is not None:
+                    self._decoded_bytes -= _pixel_bytes(image)
+                path = self._spilled.pop(handle, None)
+                if path is not None:
+                    paths.append(path)
+                self._counters["released"] += 1
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _remember_decoded(self, handle, image):
+        if handle in self._decoded:
+            self._decoded.move_to_end(handle)
+            return
+        self._decoded[handle] = image
+        self._decoded_bytes += _pixel_bytes(image)
+
+    def _enforce_budget(self):
+        # Called with the lock held.
+        decoded_budget = self.budget_bytes * DECODED_SHARE
+        while self._decoded and (self._decoded_bytes > decoded_budget
+                                 or self._decoded_bytes + self._encoded_bytes > self.budget_bytes):
+            _, image = self._decoded.popitem(last=False)
+            self._decoded_bytes -= _pixel_bytes(image)
+        while len(self._encoded) > 1 and self._decoded_bytes + self._encoded_bytes > self.budget_bytes:
+            handle, data = self._encoded.popitem(last=False)
+            self._encoded_bytes -= len(data)
+            self._spill(handle, data)
+
+    def _spill(self, handle, data):
+        os.makedirs(self.spill_dir, exist_ok=True)
+        path = os.path.join(self.spill_dir, handle)
+        with open(path, "wb") as f:
+            f.write(data)
+        self._spilled[handle] = path
+        self._counters["spills"] += 1
+
+    def close(self):
+        """Releases everything, e.g. at process exit."""
+        with self._lock:
+            handles = list(self._encoded) + list(self._spilled)
+        self.release(handles)
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._counters)
+            stats.update({
+                "encoded_bytes": self._encoded_bytes,
+                "decoded_bytes": self._decoded_bytes,
+                "in_memory": len(self._encoded),
+                "spilled": len(self._spilled),
+            })
+        return stats
+
+
+class SessionImages:
+    """
+    One session's view of the store. Everything added through it is
+    released when it is closed or garbage collected, i.e. when Streamlit
+    drops the session's state.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.handles = set()
+        self._finalizer = weakref.finalize(self, store.release, self.handles)
+
+    def put(self, image: Image.Image) -> str:
+        handle = self.store.put(image)
+        self.handles.add(handle)
+        return handle
+
+    def put_bytes(self, data: bytes, image=None) -> str:
+        handle = self.store.put_bytes(data, image)
+        self.handles.add(handle)
+        return handle
+
+    def get(self, handle: str) -> Image.Image:
+        return self.store.get(handle)
+
+    def get_bytes(self, handle: str) -> bytes:
+        return self.store.get_bytes(handle)
+
+    def discard(self, *handles):
+        """Releases handles this session no longer refers to, e.g. a replaced upload."""
+        handles = [h for h in handles if h in self.handles]
+        self.handles.difference_update(handles)
+        self.store.release(handles)
+
+    def close(self):
+        self._finalizer()
+
+
+def _decode(fp) -> Image.Image:
+    image = Image.open(fp)
+    image.load()
+    return image
+
+
+def _pixel_bytes(image: Image.Image) -> int:
+    return image.width * image.height * len(image.getbands())
+
+
+def _sweep_stale(spill_root):
+    """Removes spill directories left behind by processes that are gone."""
+    try:
+        entries = list(os.scandir(spill_root))
+    except OSError:
+        return
+    for entry in entries:
+        if not entry.is_dir() or entry.name == str(os.getpid()):
+            continue
+        try:
+            if time.time() - entry.stat().st_mtime < STALE_SPILL_SECONDS:
+                if not entry.name.isdigit():
+                    continue
+                os.kill(int(entry.name), 0)  # raises ProcessLookupError once the owner is gone
+                continue
+        except ProcessLookupError:
+            pass
+        except OSError:
+            continue
+        shutil.rmtree(entry.path, ignore_errors=True)
+
+
+image_store = ImageStore()
+atexit.register(image_store.close)
@@ -0,0 +1,80 @@
+import io
+import os
+import threading
+from PIL import Image, ImageOps
+from modules import tracing
+
+# Uploads are decoded straight to this working size; SDXL and Vision never
+# see more pixels than this anyway.
+INGEST_MAX_EDGE = int(os.getenv("INGEST_MAX_EDGE", "2048"))
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_MB", "30")) * 1024 * 1024
+# Anything claiming more pixels than this is treated as a decompression bomb.
+MAX_UPLOAD_PIXELS = int(os.getenv("MAX_UPLOAD_MEGAPIXELS", "100")) * 1_000_000
+# Largest pixel buffer one upload may decode into.
+MAX_DECODE_BYTES = int(os.getenv("MAX_DECODE_MB", "192")) * 1024 * 1024
+# Uploads decoded at once across all sessions, so peaks don't stack up.
+INGEST_CONCURRENCY = int(os.getenv("INGEST_CONCURRENCY", "2"))
+ALLOWED_FORMATS = {"JPEG", "MPO", "PNG", "WEBP"}
+ORIENTATION_TAG = 0x0112
+
+_slots = threading.BoundedSemaphore(INGEST_CONCURRENCY)
+
+
+class UploadRejected(ValueError):
+    pass
+
+
+def ingest(data: bytes, max_edge=INGEST_MAX_EDGE) -> Image.Image:
+    """
+    Decodes an uploaded image to an upright RGB image no larger than
+    `max_edge`. JPEGs are decoded at a reduced DCT scale close to the
+    target instead of at full resolution. Raises UploadRejected for files
+    that are too large, not images, or would decode into too much memory.
+    """
+    if len(data) > MAX_UPLOAD_BYTES:
+        raise UploadRejected(f"File is {len(data) / 1e6:.0f} MB; the limit is {MAX_UPLOAD_BYTES / 1e6:.0f} MB.")
+
+    with _slots, tracing.span("image.ingest", bytes_in=len(data)) as current:
+        try:
+            image = Image.open(io.BytesIO(data))
+        except (Image.UnidentifiedImageError, Image.DecompressionBombError) as e:
+            raise UploadRejected(f"Not a supported image: {e}") from None
+        if image.format not in ALLOWED_FORMATS:
+            raise UploadRejected(f"Unsupported image format {image.format}.")
+
+        width, height = image.size
+        if width * height > MAX_UPLOAD_PIXELS:
+            raise UploadRejected(
+                f"Image is {width}x{height} ({width * height / 1e6:.0f} MP); "
+                f"the limit is {MAX_UPLOAD_PIXELS / 1e6:.0f} MP."
+            )
+
+        scale = min(1.0, max_edge / max(width, height))
+        if image.format in ("JPEG", "MPO") and scale < 1.0:
+            # Let libjpeg decode at 1/2, 1/4 or 1/8 scale, never below the target size.
+            image.draft("RGB", (max(1, int(width * scale)), max(1, int(height * scale))))
+
+        decoded_bytes = image.width * image.height * max(3, len(image.getbands()))
+        if decoded_bytes > MAX_DECODE_BYTES:
+            raise UploadRejected(
+                f"Image would need {decoded_bytes / 1e6:.0f} MB to decode; "
+                f"the limit is {MAX_DECODE_BYTES / 1e6:.0f} MB."
+            )
+        try:
+            image.load()
+        except (OSError, Image.DecompressionBombError) as e:
+            raise UploadRejected(f"Could not decode image: {e}") from None
+
+        source_format = image.format
+        orientation = image.getexif().get(ORIENTATION_TAG, 1)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        if max(image.size) > max_edge:
+            image.thumbnail((max_edge, max_edge), Image.BICUBIC)
+        if orientation != 1:
+            # Rotate after downscaling: fewer pixels to move, and the bound is square anyway.
+            image.getexif()[ORIENTATION_TAG] = orientation
+            image = ImageOps.exif_transpose(image)
+
+        current.set(source=f"{width}x{height}", decoded=f"{image.width}x{image.height}", format=source_format)
+        return image
@@ -0,0 +1,123 @@
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from modules import tracing
+
+GENERATION_WORKERS = int(os.getenv("GENERATION_WORKERS", "2"))
+# Finished jobs are kept this long so a session can pick up the result.
+JOB_RETENTION_SECONDS = 15 * 60
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, job_id):
+        self.id = job_id
+        self.status = "queued"  # queued → running → done | failed | cancelled
+        self.stage = None
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self.cancel_event = threading.Event()
+        self.future = None
+
+
+class JobManager:
+    """
+    Runs long pipeline calls on a bounded worker pool so the Streamlit script
+    thread never blocks on them. Job functions are called with two extra
+    keyword arguments: `progress(stage)` to report the current stage and
+    `cancel_event`, a threading.Event they should check between steps.
+    """
+
+    def __init__(self, max_workers=GENERATION_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="generation")
+        self._jobs = {}
+        self._order = []  # queued job ids, oldest first
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs) -> str:
+        self._prune()
+        job = Job(uuid.uuid4().hex)
+
+        def progress(stage):
+            with self._lock:
+                job.stage = stage
+
+        def run():
+            with self._lock:
+                self._order.remove(job.id)
+                if job.status == "cancelled":
+                    job.finished = time.time()
+                    return
+                job.status = "running"
+            try:
+                result = fn(*args, progress=progress, cancel_event=job.cancel_event, **kwargs)
+            except JobCancelled:
+                status, result, error = "cancelled", None, None
+            except Exception as e:
+                status, result, error = "failed", None, e
+            else:
+                status, error = "done", None
+            with self._lock:
+                if job.status != "cancelled":
+                    job.status, job.result, job.error = status, result, error
+                job.finished = time.time()
+
+        with self._lock:
+            self._jobs[job.id] = job
+            self._order.append(job.id)
+        job.future = tracing.run_in_context(self._executor, run)
+        return job.id
+
+    def poll(self, job_id):
+        """
+        Snapshot of a job as a dict, or None if it is unknown or expired.
+        The result (or error) of a finished job is handed out once: the job
+        drops it on the first poll that reports the final status, so large
+        results don't wait out the retention period in memory.
+        """
+        self._prune()
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            snapshot = {
+                "id": job.id,
+                "status": job.status,
+                "stage": job.stage,
+                "result": job.result,
+                "error": job.error,
+                "position": self._order.index(job_id) + 1 if job_id in self._order else 0,
+                "elapsed": (job.finished or time.time()) - job.created,
+            }
+            if job.finished:
+                job.result = job.error = None
+            return snapshot
+
+    def cancel(self, job_id) -> bool:
+        """
+        Marks a job cancelled. Queued jobs never start; running jobs stop at
+        their next cancellation check and their result is discarded.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.status not in ("queued", "running"):
+                return False
+            job.status = "cancelled"
+            job.cancel_event.set()
+        return True
+
+    def _prune(self):
+        cutoff = time.time() - JOB_RETENTION_SECONDS
+        with self._lock:
+            for job_id in [j.id for j in self._jobs.values() if j.finished and j.finished < cutoff]:
+                del self._jobs[job_id]
+
+
+job_manager = JobManager()
@@ -0,0 +1,68 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from modules import governor, tracing
+from modules.cache import image_digest
+from modules.display import preview_bytes
+from modules.image_processor import image_to_text_google_vision
+from modules.product_search import fetch_products
+
+logger = logging.getLogger(__name__)
+
+PREFETCH_WORKERS = int(os.getenv("PREFETCH_WORKERS", "2"))
+# Warming product lookups spends SerpAPI calls on guesses, so it is opt-in.
+PREFETCH_PRODUCTS = os.getenv("PREFETCH_PRODUCTS", "0") == "1"
+PREFETCH_PRODUCT_LIMIT = 3
+
+_executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch")
+_pending = {}  # digest -> Future of the prefetch task
+_lock = threading.Lock()
+
+
+def prefetch(image: Image.Image, warm_products=PREFETCH_PRODUCTS):
+    """
+    Starts work the Generate button will need as soon as a photo is
+    uploaded: the Vision analysis (hashing and payload encoding included)
+    and the result page's preview, and optionally product lookups for the
+    objects found. A second call for the same pixels while the first is
+    running returns the same future. Failures are only logged; the real
+    request retries them.
+    """
+    digest = image_digest(image)
+    with _lock:
+        future = _pending.get(digest)
+        if future is not None:
+            return future
+        future = _pending[digest] = tracing.run_in_context(_executor, _warm, image, warm_products)
+
+    def forget(_):
+        with _lock:
+            _pending.pop(digest, None)
+
+    future.add_done_callback(forget)
+    return future
+
+
+def _warm(image: Image.Image, warm_products: bool):
+    with tracing.span("prefetch", products=warm_products):
+        try:
+            analysis = image_to_text_google_vision(image)
+        except Exception as e:
+            logger.info("Prefetched analysis failed: %s", e)
+            return None
+        preview_bytes(image)
+
+        if warm_products:
+            names = list(dict.fromkeys(
+                obj["name"] for obj in sorted(analysis["objects"], key=lambda x: -x["score"])
+            ))[:PREFETCH_PRODUCT_LIMIT]
+            for name in names:
+                try:
+                    fetch_products(name)
+                except (governor.Busy, governor.QuotaExceeded):
+                    break
+                except Exception as e:
+                    logger.info("Prefetched product search for '%s' failed: %s", name, e)
+        return analysis
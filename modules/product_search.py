@@ -1,29 +1,63 @@
-import requests
+import logging
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeout
 from dotenv import load_dotenv
+from modules import http_client, tracing
+# Imported under another name: fetch_products_concurrently has a `deadline` parameter.
+from modules import deadline as request_deadline
+from modules.product_store import product_store
+
+logger = logging.getLogger(__name__)
 
 load_dotenv()
 
 SERPAPI_API_KEY = os.getenv("SERPAPI_API_KEY")
+SERPAPI_URL = os.getenv("SERPAPI_URL", "https://serpapi.com/search")
+
+PRODUCT_SEARCH_WORKERS = int(os.getenv("PRODUCT_SEARCH_WORKERS", "4"))
+PRODUCT_CALL_TIMEOUT = float(os.getenv("PRODUCT_CALL_TIMEOUT", "10"))
+PRODUCT_SEARCH_DEADLINE = float(os.getenv("PRODUCT_SEARCH_DEADLINE", "20"))
+# With less than this left of the request deadline, searches are served from
+# the product store only and keywords it has nothing for are skipped.
+PRODUCT_MIN_BUDGET = float(os.getenv("PRODUCT_MIN_BUDGET", "2"))
+
+# Shared by every session so the number of in-flight SerpAPI calls stays bounded.
+_executor = ThreadPoolExecutor(max_workers=PRODUCT_SEARCH_WORKERS, thread_name_prefix="product-search")
 
-def fetch_products(prompt):
-    API_URL = "https://serpapi.com/search"
+AMAZON_DOMAIN = "amazon.in"
 
+def fetch_products(prompt, timeout=PRODUCT_CALL_TIMEOUT):
+    """
+    Cached product search: served from the local product store unless
+    missing or stale. Near the request deadline only cached entries are
+    used, and a miss raises deadline.DeadlineExceeded.
+    """
+    with tracing.span("products.search", keyword=prompt) as current:
+        products = product_store.get_or_fetch(
+            prompt, AMAZON_DOMAIN, lambda keyword: _fetch_products_upstream(keyword, timeout)
+        )
+        current.set(results=len(products))
+        return products
+
+def _fetch_products_upstream(prompt, timeout=PRODUCT_CALL_TIMEOUT):
+    # Background refreshes run without a deadline, so this only bites in the foreground.
+    request_deadline.check(f"a product search for '{prompt}'", PRODUCT_MIN_BUDGET)
     params = {
         "engine": "amazon",
-        "amazon_domain": "amazon.in",
+        "amazon_domain": AMAZON_DOMAIN,
         "k": prompt,  # 'k' is the correct parameter for keyword search
         "api_key": SERPAPI_API_KEY
     }
 
-    response = requests.get(API_URL, params=params)
+    response = http_client.request("serpapi", "GET", SERPAPI_URL, params=params, timeout=timeout)
     response.raise_for_status()
     data = response.json()
 
     results = data.get("organic_results", [])
     sample = results[0] if results else {}
 
-    print("Sample product data:", sample)
+    logger.debug("Sample product data: %s", sample)
 
     products = []
     for item in results[:5]:
@@ -32,3 +66,33 @@ def fetch_products(prompt):
         products.append({"name": title, "url": url})
 
     return products
+
+def fetch_products_concurrently(keywords, call_timeout=PRODUCT_CALL_TIMEOUT, deadline=PRODUCT_SEARCH_DEADLINE):
+    """
+    Runs fetch_products for every keyword on the shared worker pool and
+    yields (keyword, products, error) as each search finishes. Keywords
+    still pending when `deadline` seconds have passed are cancelled and
+    yielded with a TimeoutError. The request deadline, if any, reaches each
+    search instead: store hits are served however little time is left,
+    uncached keywords fail fast with DeadlineExceeded.
+    """
+    started = time.monotonic()
+    futures = {
+        tracing.run_in_context(_executor, fetch_products, keyword, call_timeout): keyword for keyword in keywords
+    }
+    try:
+        for future in as_completed(futures, timeout=deadline):
+            keyword = futures.pop(future)
+            try:
+                yield keyword, future.result(), None
+            except Exception as e:
+                yield keyword, [], e
+    except FuturesTimeout:
+        elapsed = time.monotonic() - started
+        for future, keyword in futures.items():
+            future.cancel()
+            yield keyword, [], request_deadline.DeadlineExceeded(f"Product search for '{keyword}' exceeded the {elapsed:.0f}s deadline")
+    finally:
+        # Consumer stopped early (e.g. Streamlit rerun): drop queued work.
+        for future in futures:
+            future.cancel()
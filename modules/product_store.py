@@ -0,0 +1,199 @@
+import difflib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from modules import tracing
+from modules.cache import CACHE_ROOT
+
+logger = logging.getLogger(__name__)
+
+PRODUCT_DB_PATH = os.getenv("PRODUCT_DB_PATH", os.path.join(CACHE_ROOT, "products.sqlite3"))
+PRODUCT_TTL = float(os.getenv("PRODUCT_TTL_HOURS", "24")) * 3600
+# Entries older than the TTL but younger than this are served while a refresh runs.
+PRODUCT_STALE_TTL = float(os.getenv("PRODUCT_STALE_TTL_HOURS", "168")) * 3600
+FUZZY_THRESHOLD = 0.85
+
+
+def normalize_keyword(keyword: str) -> str:
+    """Lowercases, strips punctuation and crudely singularizes each word ("Cushions" -> "cushion")."""
+    words = re.findall(r"[a-z0-9]+", keyword.lower())
+    normalized = []
+    for word in words:
+        if len(word) > 4 and word.endswith("ies"):
+            word = word[:-3] + "y"
+        elif len(word) > 4 and word.endswith(("ches", "shes", "sses", "xes")):
+            word = word[:-2]
+        elif len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        normalized.append(word)
+    return " ".join(normalized)
+
+
+def _similarity(a: str, b: str) -> float:
+    # Word order matters: "table lamp" and "lamp table" are different products.
+    return difflib.SequenceMatcher(None, " ".join(a.lower().split()), " ".join(b.lower().split())).ratio()
+
+
+class ProductStore:
+    """
+    SQLite-backed cache of normalized product results per (keyword, domain).
+    An FTS5 index over the keywords lets near-duplicate searches ("Couches"
+    vs "couch", "Table lamps" vs "table lamp") reuse an existing entry.
+    """
+
+    def __init__(self, path=PRODUCT_DB_PATH, ttl=PRODUCT_TTL, stale_ttl=PRODUCT_STALE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._conn = None
+        self._lock = threading.Lock()
+        self._refreshing = set()
+        self._refresher = ThreadPoolExecutor(max_workers=2, thread_name_prefix="product-refresh")
+        self._counters = {"hits": 0, "fuzzy_hits": 0, "stale_hits": 0, "misses": 0, "refreshes": 0, "store_errors": 0}
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS products (
+                    keyword TEXT NOT NULL,
+                    domain TEXT NOT NULL,
+                    products TEXT NOT NULL,
+                    fetched_at REAL NOT NULL,
+                    PRIMARY KEY (keyword, domain)
+                )
+            """)
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(keyword, domain UNINDEXED)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def _exact(self, keyword, domain):
+        with self._lock:
+            row = self._db().execute(
+                "SELECT products, fetched_at FROM products WHERE keyword = ? AND domain = ?",
+                (keyword, domain),
+            ).fetchone()
+        return (json.loads(row[0]), row[1]) if row else None
+
+    def _fuzzy(self, keyword, domain):
+        tokens = keyword.split()
+        if not tokens:
+            return None
+        match = " OR ".join(f'"{token}"' for token in tokens)
+        with self._lock:
+            rows = self._db().execute(
+                """
+                SELECT p.keyword, p.products, p.fetched_at
+                FROM products_fts f JOIN products p ON p.keyword = f.keyword AND p.domain = f.domain
+                WHERE products_fts MATCH ? AND f.domain = ?
+                ORDER BY rank LIMIT 20
+                """,
+                (match, domain),
+            ).fetchall()
+        best = max(rows, key=lambda row: _similarity(keyword, row[0]), default=None)
+        if best is None or _similarity(keyword, best[0]) < FUZZY_THRESHOLD:
+            return None
+        return json.loads(best[1]), best[2]
+
+    def save(self, keyword, domain, products):
+        keyword = normalize_keyword(keyword)
+        with self._lock:
+            db = self._db()
+            db.execute(
+                "INSERT OR REPLACE INTO products (keyword, domain, products, fetched_at) VALUES (?, ?, ?, ?)",
+                (keyword, domain, json.dumps(products), time.time()),
+            )
+            db.execute("DELETE FROM products_fts WHERE keyword = ? AND domain = ?", (keyword, domain))
+            db.execute("INSERT INTO products_fts (keyword, domain) VALUES (?, ?)", (keyword, domain))
+            db.commit()
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def _refresh(self, keyword, domain, fetch):
+        key = (normalize_keyword(keyword), domain)
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def run():
+            try:
+                with tracing.span("products.refresh", keyword=keyword):
+                    self.save(keyword, domain, fetch(keyword))
+                self._count("refreshes")
+            except Exception as e:
+                logger.warning("Background product refresh for '%s' failed: %s", keyword, e)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        self._refresher.submit(run)
+
+    def get_or_fetch(self, keyword, domain, fetch):
+        """
+        Returns cached products for `keyword`, calling `fetch(keyword)` only
+        on a miss. Stale exact entries are returned immediately and refreshed
+        in the background; if upstream fails, any cached entry is used. A
+        broken store (locked, corrupt or read-only database) is logged and
+        treated as a miss, so lookups still reach upstream.
+        """
+        normalized = normalize_keyword(keyword)
+        now = time.time()
+
+        try:
+            exact = self._exact(normalized, domain)
+            fuzzy = None if exact and now - exact[1] < self.stale_ttl else self._fuzzy(normalized, domain)
+        except (sqlite3.Error, OSError) as e:
+            logger.warning("Product store lookup for '%s' failed: %s", keyword, e)
+            self._count("store_errors")
+            exact = fuzzy = None
+
+        if exact and now - exact[1] < self.ttl:
+            self._count("hits")
+            tracing.annotate(cache="hit", cache_hit=True)
+            return exact[0]
+        if exact and now - exact[1] < self.stale_ttl:
+            self._count("stale_hits")
+            tracing.annotate(cache="stale", cache_hit=True)
+            self._refresh(keyword, domain, fetch)
+            return exact[0]
+
+        if fuzzy and now - fuzzy[1] < self.ttl:
+            self._count("fuzzy_hits")
+            tracing.annotate(cache="fuzzy", cache_hit=True)
+            return fuzzy[0]
+
+        self._count("misses")
+        tracing.annotate(cache="miss")
+        try:
+            products = fetch(keyword)
+        except Exception:
+            fallback = exact or fuzzy
+            if fallback is None:
+                raise
+            tracing.annotate(cache="fallback", cache_hit=True)
+            return fallback[0]
+        try:
+            self.save(keyword, domain, products)
+        except (sqlite3.Error, OSError) as e:
+            logger.warning("Product store save for '%s' failed: %s", keyword, e)
+            self._count("store_errors")
+        return products
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._counters)
+
+
+product_store = ProductStore()
@@ -0,0 +1,149 @@
+import os
+from PIL import Image
+from modules.change_detection import box_iou, changed_regions, crop, to_image_box
+from modules.image_processor import annotate_images, generate_high_quality_image, image_to_text_google_vision
+from modules import deadline, tracing
+from modules.jobs import JobCancelled
+
+LABEL_FEATURES = [{"type": "LABEL_DETECTION", "maxResults": 10}]
+REGION_FEATURES = [{"type": "OBJECT_LOCALIZATION", "maxResults": 5}, {"type": "LABEL_DETECTION", "maxResults": 5}]
+# "0" falls back to diffing whole-image label sets.
+CHANGE_DETECTION = os.getenv("CHANGE_DETECTION", "1") == "1"
+# An object in a changed region matching an original object of the same
+# name with at least this overlap is the same item, restyled.
+SAME_ITEM_IOU = 0.3
+MIN_LABEL_SCORE = 0.6
+# Item detection is skipped when less than this is left of the request
+# deadline; the redesign is still returned, just without product suggestions.
+DETECTION_MIN_BUDGET = float(os.getenv("DETECTION_MIN_BUDGET", "3"))
+
+# Labels describing the room itself rather than something that could be bought.
+ROOM_KEYWORDS = {
+    "wall", "floor", "ceiling", "room", "house", "lighting", "wood", "window",
+    "interior design", "home", "architecture", "tile", "fixture",
+    "living room", "dining room", "bedroom", "kitchen", "bathroom",
+    "hallway", "office", "study", "closet", "garage", "laundry room"
+}
+
+
+def _is_room(label: str) -> bool:
+    return any(room in label.lower() for room in ROOM_KEYWORDS)
+
+
+def detect_labels_many(images: list) -> tuple:
+    """
+    Label detection for several images in a single batched Vision round
+    trip. Returns (labels per image, error messages); an image whose
+    annotation failed gets an empty label list.
+    """
+    labels, errors = [], []
+    for result in annotate_images([(image, LABEL_FEATURES) for image in images]):
+        if "error" in result:
+            err = result["error"]
+            errors.append(f"Google Vision API error: {err.get('message', str(err))}")
+            labels.append([])
+        else:
+            labels.append([annotation["description"] for annotation in result.get("labelAnnotations", [])])
+    return labels, errors
+
+
+@tracing.traced("labels.diff")
+def find_new_items(before_labels, after_labels) -> list:
+    return [
+        label for label in set(after_labels) - set(before_labels)
+        if not _is_room(label)
+    ]
+
+
+def _bounds(vertices) -> tuple:
+    xs, ys = [v[0] for v in vertices], [v[1] for v in vertices]
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+@tracing.traced("labels.regions")
+def detect_new_items(original: Image.Image, stylized: Image.Image) -> tuple:
+    """
+    Item-level "what was added": finds the regions that changed between the
+    two images, sends only crops of those regions to Vision in one batch and
+    compares the objects found there with the original's object boxes (from
+    the cached analysis). Returns (items, errors); each item is a dict with
+    "name", normalized "box" and "score".
+    """
+    regions = changed_regions(original, stylized)
+    if not regions:
+        return [], []
+    items, errors = [], []
+    try:
+        # Served from the Vision cache filled when the original was analyzed for the prompt.
+        originals = [
+            (obj["name"].lower(), _bounds(obj["box"]))
+            for obj in image_to_text_google_vision(original)["objects"] if obj["box"]
+        ]
+    except RuntimeError as e:
+        errors.append(str(e))
+        originals = []
+
+    results = annotate_images([(crop(stylized, region["box"]), REGION_FEATURES) for region in regions])
+    for region, result in zip(regions, results):
+        if "error" in result:
+            err = result["error"]
+            errors.append(f"Google Vision API error: {err.get('message', str(err))}")
+            continue
+        found = []
+        for obj in result.get("localizedObjectAnnotations", []):
+            box = to_image_box(region["box"], obj["boundingPoly"]["normalizedVertices"])
+            found.append((obj["name"], box, obj["score"]))
+        if not found:
+            # No object box in the crop: fall back to its best label for the whole region.
+            found = [
+                (label["description"], region["box"], label["score"])
+                for label in result.get("labelAnnotations", [])[:1] if label["score"] >= MIN_LABEL_SCORE
+            ]
+        for name, box, score in found:
+            if _is_room(name):
+                continue
+            if any(name.lower() == orig_name and box_iou(box, orig_box) >= SAME_ITEM_IOU
+                   for orig_name, orig_box in originals):
+                continue
+            items.append({"name": name, "box": box, "score": score})
+    tracing.annotate(regions=len(regions), items=len(items))
+    return items, errors
+
+
+@tracing.traced("redesign")
+def run_redesign(image: Image.Image, style_description: str, seed=None, use_cache=True,
+                 progress=None, cancel_event=None) -> dict:
+    """
+    Full Generate Redesign pipeline minus the product search: returns the
+    stylized image, the newly added items and any non-fatal warnings.
+    Inside a deadline.scope, item detection is optional: it is skipped
+    (with a warning) rather than failing the redesign when time runs out.
+    """
+    stylized = generate_high_quality_image(
+        image, style_description, seed=seed, use_cache=use_cache,
+        progress=progress, cancel_event=cancel_event,
+    )
+
+    if cancel_event is not None and cancel_event.is_set():
+        raise JobCancelled()
+    if progress is not None:
+        progress("detecting products")
+    try:
+        deadline.check("detecting new items", DETECTION_MIN_BUDGET)
+        if CHANGE_DETECTION:
+            items, errors = detect_new_items(image, stylized)
+            new_items = list(dict.fromkeys(item["name"] for item in items))
+        else:
+            (before_labels, after_labels), errors = detect_labels_many([image, stylized])
+            items, new_items = [], find_new_items(before_labels, after_labels)
+    except deadline.DeadlineExceeded:
+        tracing.annotate(degraded="detection")
+        items, new_items = [], []
+        errors = ["Skipped detecting newly added items to stay within the time limit."]
+
+    return {
+        "image": stylized,
+        "new_items": new_items,
+        "new_item_boxes": items,
+        "warnings": errors,
+    }
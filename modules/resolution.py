@@ -0,0 +1,69 @@
+import math
+import os
+import threading
+from PIL import Image
+from modules import tracing
+
+# "bucket" renders at the SDXL training resolution closest to the input's
+# aspect ratio (about one megapixel) and resizes the result locally;
+# "native" sends the input size rounded down to a multiple of 16.
+RESOLUTION_POLICY = os.getenv("RESOLUTION_POLICY", "bucket")
+
+# Aspect buckets SDXL was trained on, all close to 1024x1024 pixels.
+SDXL_BUCKETS = [
+    (1024, 1024),
+    (1152, 896), (896, 1152),
+    (1216, 832), (832, 1216),
+    (1344, 768), (768, 1344),
+    (1536, 640), (640, 1536),
+]
+UPSCALE_FILTER = Image.BICUBIC
+
+_lock = threading.Lock()
+_stats = {"generations": 0, "generation_seconds": 0.0, "estimated_seconds_saved": 0.0, "pixels_saved": 0}
+
+
+def native_size(width: int, height: int) -> tuple:
+    return (width // 16) * 16, (height // 16) * 16
+
+
+def generation_size(width: int, height: int) -> tuple:
+    """Width and height to request from SDXL for an input of this size."""
+    if RESOLUTION_POLICY == "native":
+        return native_size(width, height)
+    aspect = math.log(width / height)
+    return min(SDXL_BUCKETS, key=lambda size: abs(math.log(size[0] / size[1]) - aspect))
+
+
+def fit_output(image: Image.Image, size: tuple) -> Image.Image:
+    """Resizes a render back to the size of the image it was made from."""
+    if image.size == tuple(size):
+        return image
+    with tracing.span("image.resize", source=f"{image.width}x{image.height}", target=f"{size[0]}x{size[1]}"):
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        return image.resize(size, UPSCALE_FILTER)
+
+
+def record_generation(input_size: tuple, generated_size: tuple, seconds: float) -> float:
+    """
+    Books one SDXL call and returns the estimated seconds saved against
+    rendering at the input's own size. Diffusion cost grows at least
+    linearly with pixel count, so the estimate scales the measured time
+    by the pixel ratio; it is negative when the bucket is larger.
+    """
+    native = native_size(*input_size)
+    native_pixels = native[0] * native[1]
+    generated_pixels = generated_size[0] * generated_size[1]
+    saved = seconds * (native_pixels / generated_pixels - 1) if generated_pixels else 0.0
+    with _lock:
+        _stats["generations"] += 1
+        _stats["generation_seconds"] += seconds
+        _stats["estimated_seconds_saved"] += saved
+        _stats["pixels_saved"] += native_pixels - generated_pixels
+    return saved
+
+
+def resolution_stats() -> dict:
+    with _lock:
+        return dict(_stats, policy=RESOLUTION_POLICY)
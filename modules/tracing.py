@@ -0,0 +1,223 @@
+import contextvars
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TRACE_LOG = os.getenv("TRACE_LOG", "1") == "1"
+METRIC_PREFIX = "spacelogic"
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_trace_log = logging.getLogger("trace")
+if TRACE_LOG and not _trace_log.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    _trace_log.addHandler(_handler)
+    _trace_log.setLevel(logging.INFO)
+    _trace_log.propagate = False
+
+_current = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    """
+    One timed stage. Attributes with special meaning for metrics:
+    bytes_in, bytes_out, cache_hits, retries and upstream_status.
+    """
+
+    def __init__(self, name, parent=None, **attrs):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex[:16]
+        self.span_id = uuid.uuid4().hex[:8]
+        self.parent_id = parent.span_id if parent else None
+        self.attrs = dict(attrs)
+        self.status = "ok"
+        self.error = None
+        self.started = time.perf_counter()
+        self.duration = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def add(self, key, amount=1):
+        self.attrs[key] = self.attrs.get(key, 0) + amount
+
+
+@contextmanager
+def span(name, **attrs):
+    """Times the enclosed block as `name`, nested under the current span if any."""
+    current = Span(name, _current.get(), **attrs)
+    try:
+        with use(current):
+            yield current
+    except BaseException as e:
+        finish(current, e)
+        raise
+    finish(current)
+
+
+@contextmanager
+def use(current: Span):
+    """Makes `current` the parent of spans opened in the block without ending it."""
+    token = _current.set(current)
+    try:
+        yield current
+    finally:
+        _current.reset(token)
+
+
+def finish(current: Span, error=None):
+    """Ends a span started by hand (e.g. one that lives as long as a generator) and records it."""
+    current.duration = time.perf_counter() - current.started
+    if error is not None:
+        current.status = "error"
+        current.error = f"{type(error).__name__}: {error}"
+    _record(current)
+
+
+def traced(name):
+    """Decorator form of span() for plain (non-generator) functions."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def current_span():
+    return _current.get()
+
+
+def annotate(**attrs):
+    """Sets attributes on the current span, if there is one."""
+    current = _current.get()
+    if current is not None:
+        current.set(**attrs)
+
+
+def count(key, amount=1):
+    current = _current.get()
+    if current is not None:
+        current.add(key, amount)
+
+
+def run_in_context(executor, fn, *args, **kwargs):
+    """executor.submit that carries the caller's context (current span and other context vars) into the worker."""
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+# ─── Metrics ─────────────────────────────────────────────────────────────────
+_lock = threading.Lock()
+_histograms = {}  # stage -> [bucket counts..., +Inf count, sum]
+_counters = {}    # (metric, labels tuple) -> value
+
+
+def _inc(metric, labels, amount=1):
+    key = (metric, labels)
+    _counters[key] = _counters.get(key, 0) + amount
+
+
+def _record(current: Span):
+    with _lock:
+        hist = _histograms.setdefault(current.name, [0] * (len(DURATION_BUCKETS) + 1) + [0.0])
+        for i, bound in enumerate(DURATION_BUCKETS):
+            if current.duration <= bound:
+                hist[i] += 1
+        hist[len(DURATION_BUCKETS)] += 1
+        hist[-1] += current.duration
+
+        stage = (("stage", current.name),)
+        _inc("stage_calls_total", stage + (("status", current.status),))
+        for attr, metric in (("bytes_in", "bytes_in_total"), ("bytes_out", "bytes_out_total"),
+                             ("cache_hits", "cache_hits_total"), ("retries", "upstream_retries_total")):
+            value = current.attrs.get(attr)
+            if isinstance(value, (int, float)) and not isinstance(value, bool) and value:
+                _inc(metric, stage, value)
+        if current.attrs.get("cache_hit") is True:
+            _inc("cache_hits_total", stage)
+        if "upstream_status" in current.attrs:
+            _inc("upstream_responses_total", stage + (("code", str(current.attrs["upstream_status"])),))
+
+    if TRACE_LOG:
+        record = {
+            "ts": round(time.time(), 3),
+            "trace_id": current.trace_id,
+            "span_id": current.span_id,
+            "parent_id": current.parent_id,
+            "span": current.name,
+            "duration_ms": round(current.duration * 1000, 2),
+            "status": current.status,
+        }
+        if current.error:
+            record["error"] = current.error
+        record.update(current.attrs)
+        _trace_log.info(json.dumps(record, default=str))
+
+
+def _labels(pairs) -> str:
+    return ",".join(f'{k}="{v}"' for k, v in pairs)
+
+
+def render_prometheus() -> str:
+    """Current metrics in the Prometheus text exposition format."""
+    lines = [
+        f"# HELP {METRIC_PREFIX}_stage_duration_seconds Duration of each pipeline stage.",
+        f"# TYPE {METRIC_PREFIX}_stage_duration_seconds histogram",
+    ]
+    with _lock:
+        for stage, hist in sorted(_histograms.items()):
+            for i, bound in enumerate(DURATION_BUCKETS):
+                lines.append(f'{METRIC_PREFIX}_stage_duration_seconds_bucket{{stage="{stage}",le="{bound}"}} {hist[i]}')
+            total = hist[len(DURATION_BUCKETS)]
+            lines.append(f'{METRIC_PREFIX}_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {total}')
+            lines.append(f'{METRIC_PREFIX}_stage_duration_seconds_sum{{stage="{stage}"}} {hist[-1]:.6f}')
+            lines.append(f'{METRIC_PREFIX}_stage_duration_seconds_count{{stage="{stage}"}} {total}')
+
+        by_metric = {}
+        for (metric, labels), value in _counters.items():
+            by_metric.setdefault(metric, []).append((labels, value))
+        for metric, samples in sorted(by_metric.items()):
+            lines.append(f"# TYPE {METRIC_PREFIX}_{metric} counter")
+            for labels, value in sorted(samples):
+                lines.append(f"{METRIC_PREFIX}_{metric}{{{_labels(labels)}}} {value}")
+    return "\n".join(lines) + "\n"
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_metrics_server(port: int):
+    """Serves /metrics on `port` from a daemon thread; safe to call on every Streamlit rerun."""
+    global _server
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_response(404)
+                self.end_headers()
+                return
+            body = render_prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    with _server_lock:
+        if _server is not None:
+            return _server
+        _server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+        _server.daemon_threads = True
+        threading.Thread(target=_server.serve_forever, daemon=True, name="metrics").start()
+        return _server
@@ -0,0 +1,83 @@
+import base64
+import io
+import os
+import threading
+from collections import OrderedDict
+from PIL import Image
+from modules import tracing
+
+# Longest edge sent to Vision per feature. Labels and colours are stable at
+# low resolution; object boxes and especially OCR need more pixels.
+FEATURE_MAX_EDGE = {
+    "LABEL_DETECTION": int(os.getenv("VISION_EDGE_LABELS", "640")),
+    "IMAGE_PROPERTIES": int(os.getenv("VISION_EDGE_PROPERTIES", "512")),
+    "OBJECT_LOCALIZATION": int(os.getenv("VISION_EDGE_OBJECTS", "1024")),
+    "TEXT_DETECTION": int(os.getenv("VISION_EDGE_TEXT", "1600")),
+}
+DEFAULT_MAX_EDGE = 1024
+JPEG_QUALITY = int(os.getenv("VISION_JPEG_QUALITY", "85"))
+ENCODED_CACHE_ENTRIES = 32
+
+_encoded = OrderedDict()
+_lock = threading.Lock()
+_stats = {"encoded": 0, "reused": 0, "bytes_sent": 0, "bytes_full_estimate": 0}
+
+
+def max_edge_for(features: list) -> int:
+    return max((FEATURE_MAX_EDGE.get(f["type"], DEFAULT_MAX_EDGE) for f in features), default=DEFAULT_MAX_EDGE)
+
+
+def encode_for_vision(image: Image.Image, features: list, digest: str) -> tuple:
+    """
+    Returns (base64 JPEG, scale) for sending `image` to Vision with
+    `features`, where scale is encoded size / original size. The image is
+    downscaled to the features' max edge and encoded in memory once per
+    (digest, edge); later calls reuse the bytes.
+    """
+    edge = max_edge_for(features)
+    key = (digest, edge, JPEG_QUALITY)
+    with _lock:
+        if key in _encoded:
+            _encoded.move_to_end(key)
+            _stats["reused"] += 1
+            content, scale, sent = _encoded[key]
+            _stats["bytes_sent"] += sent
+            _stats["bytes_full_estimate"] += int(sent / (scale * scale))
+            return content, scale
+
+    with tracing.span("vision.encode", max_edge=edge) as current:
+        content, scale, sent = _encode(image, edge)
+        current.set(bytes_out=sent, scale=round(scale, 4))
+
+    with _lock:
+        _encoded[key] = (content, scale, sent)
+        while len(_encoded) > ENCODED_CACHE_ENTRIES:
+            _encoded.popitem(last=False)
+        _stats["encoded"] += 1
+        _stats["bytes_sent"] += sent
+        # JPEG size scales roughly with pixel count.
+        _stats["bytes_full_estimate"] += int(sent / (scale * scale))
+    return content, scale
+
+
+def _encode(image: Image.Image, edge: int) -> tuple:
+    """Downscales to `edge` and JPEG-encodes; returns (base64, scale, encoded bytes)."""
+    scale = min(1.0, edge / max(image.width, image.height))
+    if scale < 1.0:
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        image = image.resize(size, Image.BILINEAR, reducing_gap=2.0)
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    buffered = io.BytesIO()
+    image.save(buffered, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+    sent = buffered.tell()
+    content = base64.b64encode(buffered.getvalue()).decode()
+    return content, scale, sent
+
+
+def encoder_stats() -> dict:
+    with _lock:
+        stats = dict(_stats)
+    stats["bytes_saved"] = stats["bytes_full_estimate"] - stats["bytes_sent"]
+    return stats